@@ -0,0 +1,112 @@
+import asyncio
+import json
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import AsyncIterable, Callable, Deque, List, Optional, Tuple
+from fastapi.concurrency import run_in_threadpool
+from . import finance, streaming
+
+
+# 0 keeps portfolio work on the threadpool of the serving process.
+ANALYTICS_WORKERS: int = int(os.environ.get("LOAN_APP_ANALYTICS_WORKERS", "0"))
+ANALYTICS_CHUNK_SIZE: int = int(os.environ.get("LOAN_APP_ANALYTICS_CHUNK_SIZE", "500"))
+# Scenario runs are chunked by (product x scenario) lanes, which bounds the
+# working arrays at roughly 150 bytes per lane. Each requested balance month
+# adds a column per lane, so the budget is shared with those.
+SCENARIO_CHUNK_LANES: int = int(os.environ.get("LOAN_APP_SCENARIO_CHUNK_LANES", "250000"))
+
+
+class AnalyticsPool:
+    def __init__(self, workers: int = ANALYTICS_WORKERS):
+        self.workers: int = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self):
+        if self.workers > 0 and self._executor is None:
+            # spawn rather than fork: the parent is running an event loop
+            # and a threadpool that must not be copied into the workers.
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def submit(self, function: Callable, *args):
+        if self._executor is None:
+            return asyncio.ensure_future(run_in_threadpool(function, *args))
+        return asyncio.get_running_loop().run_in_executor(self._executor, partial(function, *args))
+
+    async def imap(self, function: Callable, arguments: AsyncIterable[Tuple]):
+        # Results come back in submission order while up to one chunk per
+        # worker (plus one) is in flight, so streaming callers stay bounded.
+        max_pending: int = max(self.workers, 1) + 1
+        pending: Deque[asyncio.Future] = deque()
+        try:
+            async for args in arguments:
+                pending.append(self.submit(function, *args))
+                if len(pending) >= max_pending:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+analytics_pool: AnalyticsPool = AnalyticsPool()
+
+
+async def iter_chunks(items: List, chunk_size: Optional[int] = None):
+    chunk_size = chunk_size or ANALYTICS_CHUNK_SIZE
+    for start in range(0, len(items), chunk_size):
+        yield (items[start:start + chunk_size],)
+
+
+def format_loan_schedules_batch(chunk: List[Tuple[int, Optional[finance.LoanTerms]]]):
+    chunk_loans: List[finance.LoanTerms] = [loan_terms for _, loan_terms in chunk if loan_terms is not None]
+    portfolio_schedules = finance.get_portfolio_schedules(chunk_loans)
+    lines: List[str] = []
+    index: int = 0
+    for loan_id, loan_terms in chunk:
+        if loan_terms is None:
+            lines.append(json.dumps({"loan_id": loan_id, "detail": "Loan not found"}) + "\n")
+            continue
+        loan_schedule_columns = portfolio_schedules.get_loan_schedule_columns(index)
+        index += 1
+        lines.append(json.dumps({
+            "loan_id": loan_id,
+            "schedule": loan_schedule_columns.to_rows()
+        }) + "\n")
+    return "".join(lines)
+
+
+def format_loan_schedules_export(media_type: str, loans: List[finance.LoanTerms]):
+    return streaming.format_portfolio_schedules(media_type, finance.get_portfolio_schedules(loans))
+
+
+async def get_portfolio_cashflows(products: List[finance.LoanProduct]):
+    cashflows: List[finance.CashflowColumns] = [
+        cashflow async for cashflow in analytics_pool.imap(finance.get_portfolio_cashflows, iter_chunks(products))
+    ]
+    return finance.add_cashflows(cashflows)
+
+
+async def get_portfolio_scenarios(
+    products: List[finance.LoanProduct], scenario_columns: finance.ScenarioColumns, balance_months: List[int]
+):
+    chunk_size: int = max(SCENARIO_CHUNK_LANES // (len(scenario_columns.extra_principal) * (1 + len(balance_months))), 1)
+    get_totals = partial(
+        finance.get_portfolio_scenario_totals, scenario_columns=scenario_columns, balance_months=balance_months
+    )
+    totals: List[finance.ScenarioTotals] = [
+        scenario_totals async for scenario_totals in analytics_pool.imap(get_totals, iter_chunks(products, chunk_size))
+    ]
+    if not totals:
+        return get_totals([])
+    return finance.add_scenario_totals(totals)
@@ -0,0 +1,271 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from . import finance, migrations, models, schemas
+from .database import Base
+from .main import create_app, get_db
+
+
+TERMS: List[int] = [120, 360, 480]
+PRODUCT_COUNT: int = 200
+DEFAULT_ROWS: int = 100000
+DEFAULT_THRESHOLD: float = 0.25
+# Runs in a fresh interpreter per sample, so every phase is measured cold.
+# The test client is imported only after the app exists so its own imports
+# are not counted against loan_app.
+STARTUP_SCRIPT: str = """
+import json, time
+start = time.perf_counter()
+from loan_app import main
+imported = time.perf_counter()
+app = main.create_app()
+created = time.perf_counter()
+from fastapi.testclient import TestClient
+with TestClient(app) as client:
+    client_started = time.perf_counter()
+    client.get("/")
+    first_request = time.perf_counter()
+    client.get("/")
+    second_request = time.perf_counter()
+print(json.dumps({
+    "startup.import loan_app.main": imported - start,
+    "startup.create_app": created - imported,
+    "startup.lifespan": client_started - created,
+    "startup.first request": first_request - client_started,
+    "startup.second request": second_request - first_request
+}))
+"""
+
+
+def time_function(function: Callable, number: int, repeat: int = 5):
+    timings: List[float] = [timing / number for timing in timeit.repeat(function, number=number, repeat=repeat)]
+    return {"min_us": min(timings) * 1e6, "median_us": statistics.median(timings) * 1e6}
+
+
+def time_requests(request: Callable, number: int, budget: float):
+    # Stops early once `budget` seconds are spent so a pathological endpoint
+    # still reports a number instead of stalling the run.
+    request()
+    latencies: List[float] = []
+    deadline: float = time.perf_counter() + budget
+    while len(latencies) < number and (len(latencies) < 3 or time.perf_counter() < deadline):
+        start: float = time.perf_counter()
+        request()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "min_us": latencies[0] * 1e6,
+        "median_us": statistics.median(latencies) * 1e6,
+        "p95_us": latencies[max(int(len(latencies) * 0.95) - 1, 0)] * 1e6,
+        "requests_per_sec": len(latencies) / sum(latencies)
+    }
+
+
+def run_startup_benchmarks(runs: int, exclude: List[str]):
+    # Lifespan time includes the test client's own startup and the
+    # migrations on the default in-memory database; "process" is the whole
+    # child from spawn to exit, interpreter start included.
+    samples: Dict[str, List[float]] = {}
+    for _ in range(runs):
+        start: float = time.perf_counter()
+        output: str = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT], check=True, capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        ).stdout
+        samples.setdefault("startup.process", []).append(time.perf_counter() - start)
+        for name, seconds in json.loads(output.splitlines()[-1]).items():
+            samples.setdefault(name, []).append(seconds)
+    return {
+        name: {"min_us": min(timings) * 1e6, "median_us": statistics.median(timings) * 1e6}
+        for name, timings in samples.items()
+        if not any(pattern in name for pattern in exclude)
+    }
+
+
+def run_finance_benchmarks(exclude: List[str]):
+    benchmarks: Dict[str, Tuple[Callable, int]] = {}
+    for term in TERMS:
+        loan = models.Loan(id=1, amount=50000000, rate=600, term=term)
+        benchmarks[f"finance.get_pmt[term={term}]"] = (partial(finance.get_pmt, 50000000, 600, term), 20000)
+        benchmarks[f"finance.get_loan_schedule[term={term}]"] = (partial(finance.get_loan_schedule, loan), 50)
+        benchmarks[f"finance.get_loan_schedule_columns[term={term}]"] = (
+            partial(finance.get_loan_schedule_columns, 50000000, 600, term), 200
+        )
+        for month in [1, term - 1]:
+            benchmarks[f"finance.get_loan_summary[term={term},month={month}]"] = (
+                partial(finance.get_loan_summary, loan, month), 200
+            )
+    loans: List[finance.LoanTerms] = [
+        finance.LoanTerms(index, 10000000 + index * 1000, 300 + index % 500, TERMS[index % len(TERMS)])
+        for index in range(1000)
+    ]
+    benchmarks["finance.get_portfolio_schedules[loans=1000]"] = (partial(finance.get_portfolio_schedules, loans), 1)
+    scenario_columns: finance.ScenarioColumns = finance.get_scenario_columns([
+        schemas.LoanScenario(extra_principal=index * 1000, lump_sum=index * 10000, lump_sum_month=index % 60 + 1)
+        for index in range(1000)
+    ])
+    benchmarks["finance.get_scenario_totals[loans=100,scenarios=1000]"] = (
+        partial(finance.get_scenario_totals, loans[:100], scenario_columns, [12, 60]), 1
+    )
+    return {
+        name: time_function(function, number)
+        for name, (function, number) in benchmarks.items()
+        if not any(pattern in name for pattern in exclude)
+    }
+
+
+def seed_database(session_local: sessionmaker, rows: int):
+    # `rows` users and `rows` loans drawn from PRODUCT_COUNT standard
+    # products, each loan with one or two borrowers.
+    seeded_random = random.Random(0)
+    products = [
+        (seeded_random.randrange(50, 1000) * 100000, seeded_random.randrange(200, 1200, 25), seeded_random.choice(TERMS))
+        for _ in range(PRODUCT_COUNT)
+    ]
+    db = session_local()
+    db.execute(insert(models.User), [{"email": f"user{index}@email.com"} for index in range(1, rows + 1)])
+    loan_rows = []
+    for _ in range(rows):
+        amount, rate, term = seeded_random.choice(products)
+        loan_rows.append({"amount": amount, "rate": rate, "term": term})
+    db.execute(insert(models.Loan), loan_rows)
+    user_loan_rows = [{"user_id": loan_id, "loan_id": loan_id} for loan_id in range(1, rows + 1)]
+    user_loan_rows += [{"user_id": rows + 1 - loan_id, "loan_id": loan_id} for loan_id in range(1, rows + 1, 2)]
+    db.execute(insert(models.UserLoan), user_loan_rows)
+    migrations.analyze(db.connection())
+    db.commit()
+    db.close()
+
+
+def run_api_benchmarks(rows: int, number: int, budget: float, exclude: List[str]):
+    engine = create_engine("sqlite:///:memory:", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    Base.metadata.create_all(bind=engine)
+    seed_database(session_local, rows)
+
+    def override_get_db():
+        db = session_local()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app = create_app()
+    app.dependency_overrides[get_db] = override_get_db
+    client = TestClient(app)
+    seeded_random = random.Random(1)
+    emails = (f"bench{index}@email.com" for index in range(sys.maxsize))
+    deep_cursor: Optional[str] = client.get(f"/loans/?skip={rows - 200}&limit=100").headers.get("X-Next-Cursor")
+
+    def uncached_schedule():
+        finance.schedule_cache.clear()
+        client.get(f"/loans/{seeded_random.randint(1, rows)}/schedule")
+
+    benchmarks: Dict[str, Callable] = {
+        "api.GET /loans/{id}/schedule": lambda: client.get(f"/loans/{seeded_random.randint(1, rows)}/schedule"),
+        "api.GET /loans/{id}/schedule[uncached]": uncached_schedule,
+        "api.GET /loans/{id}/summary": lambda: client.get(f"/loans/{seeded_random.randint(1, rows)}/summary?month=12"),
+        "api.GET /loans/{id}": lambda: client.get(f"/loans/{seeded_random.randint(1, rows)}"),
+        "api.GET /loans/[limit=100]": lambda: client.get("/loans/?limit=100"),
+        "api.GET /loans/[deep offset]": lambda: client.get(f"/loans/?skip={rows - 100}&limit=100"),
+        "api.GET /loans/[deep cursor]": lambda: client.get(f"/loans/?limit=100&cursor={deep_cursor}"),
+        "api.GET /quotes": lambda: client.get(f"/quotes?amount={seeded_random.randint(1, 1000) * 10000}&rate=400&term=360"),
+        "api.GET /quotes[grid 121x12]": lambda: client.get("/quotes?amount=10000000&rate=0:3000:25&term=12:84:12,120,180,240,300,360"),
+        "api.GET /loans/search[term,rate]": lambda: client.get("/loans/search?term_min=360&term_max=360&rate_min=600&limit=100"),
+        "api.GET /loans/search[balance]": lambda: client.get(
+            "/loans/search?term_min=360&term_max=360&rate_min=600&rate_max=1200&month=12&balance_min=50000000&limit=100"
+        ),
+        "api.GET /users/[limit=100]": lambda: client.get("/users/?limit=100"),
+        "api.GET /users/{id}/loans": lambda: client.get(f"/users/{seeded_random.randint(1, rows)}/loans"),
+        "api.POST /users/": lambda: client.post("/users/", json={"email": next(emails)}),
+        "api.POST /users/loans/": lambda: client.post("/users/loans/", json={
+            "user_ids": [seeded_random.randint(1, rows)], "amount": 10000000, "rate": 400, "term": 360
+        }),
+    }
+    try:
+        return {
+            name: time_requests(request, number, budget)
+            for name, request in benchmarks.items()
+            if not any(pattern in name for pattern in exclude)
+        }
+    finally:
+        engine.dispose()
+
+
+def compare(results: Dict, baseline: Dict, threshold: float):
+    # A benchmark regresses when both its min and its median are slower than
+    # baseline * (1 + threshold); requiring both keeps one noisy repeat from
+    # failing the run. Benchmarks missing from the baseline are reported only.
+    regressions: List[str] = []
+    print(f"{'benchmark':<52} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, result in results["benchmarks"].items():
+        baseline_result = baseline["benchmarks"].get(name)
+        if baseline_result is None:
+            print(f"{name:<52} {'-':>12} {result['median_us']:>10.1f}us {'new':>8}")
+            continue
+        change: float = result["median_us"] / baseline_result["median_us"] - 1
+        min_change: float = result["min_us"] / baseline_result["min_us"] - 1
+        flag: str = ""
+        if change > threshold and min_change > threshold:
+            regressions.append(name)
+            flag = " REGRESSION"
+        print(f"{name:<52} {baseline_result['median_us']:>10.1f}us {result['median_us']:>10.1f}us {change:>+7.0%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the finance functions and the API against a seeded database.")
+    parser.add_argument("--suite", choices=["all", "finance", "api", "startup"], default="all")
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS, help="users and loans to seed for the api suite")
+    parser.add_argument("--requests", type=int, default=200, help="requests per api benchmark")
+    parser.add_argument("--startup-runs", type=int, default=10, help="fresh interpreters started for the startup suite")
+    parser.add_argument("--budget", type=float, default=10.0, help="seconds to spend per api benchmark at most")
+    parser.add_argument("--exclude", action="append", default=[], help="skip benchmarks whose name contains this")
+    parser.add_argument("--output", help="write results as JSON to this path")
+    parser.add_argument("--compare", help="baseline JSON to compare against; exits 1 on regression")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="allowed slowdown, e.g. 0.25 for 25%%")
+    args = parser.parse_args()
+
+    benchmarks: Dict[str, Dict[str, float]] = {}
+    if args.suite in ("all", "finance"):
+        benchmarks.update(run_finance_benchmarks(args.exclude))
+    if args.suite in ("all", "api"):
+        benchmarks.update(run_api_benchmarks(args.rows, args.requests, args.budget, args.exclude))
+    if args.suite in ("all", "startup"):
+        benchmarks.update(run_startup_benchmarks(args.startup_runs, args.exclude))
+    results: Dict = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "rows": args.rows,
+        "benchmarks": benchmarks
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline: Dict = json.load(baseline_file)
+        regressions: List[str] = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed more than {args.threshold:.0%}")
+            sys.exit(1)
+    else:
+        for name, result in benchmarks.items():
+            print(f"{name:<52} {result['median_us']:>10.1f}us")
+
+
+if __name__ == "__main__":
+    main()
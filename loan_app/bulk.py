@@ -0,0 +1,75 @@
+import json
+import os
+from typing import Any, Callable, List, Optional, Tuple, Type
+from fastapi import HTTPException
+from pydantic import BaseModel, ValidationError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from . import schemas
+from .streaming import NDJSON_MEDIA_TYPE
+
+
+BULK_CHUNK_SIZE: int = int(os.environ.get("LOAN_APP_BULK_CHUNK_SIZE", "1000"))
+
+
+class InvalidItem:
+    def __init__(self, detail: str):
+        self.detail: str = detail
+
+
+def parse_bulk_body(body: bytes, content_type: str):
+    # NDJSON is parsed line by line so one bad line only fails its own item;
+    # anything else must be a single JSON array.
+    if content_type.split(";")[0].strip() == NDJSON_MEDIA_TYPE:
+        items: List[Any] = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(InvalidItem("Invalid JSON"))
+        return items
+    try:
+        items = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array")
+    return items
+
+
+def get_validation_detail(error: ValidationError):
+    return "; ".join(
+        f"{'.'.join(str(loc) for loc in curr_error['loc'])}: {curr_error['msg']}" if curr_error["loc"] else curr_error["msg"]
+        for curr_error in error.errors()
+    )
+
+
+def create_bulk(db: Session, items: List[Any], schema: Type[BaseModel], create_chunk: Callable, chunk_size: int = BULK_CHUNK_SIZE):
+    results: List[schemas.BulkItemResult] = []
+    for start in range(0, len(items), chunk_size):
+        chunk_indexes: List[int] = []
+        chunk_creates: List[BaseModel] = []
+        for index in range(start, min(start + chunk_size, len(items))):
+            item = items[index]
+            if isinstance(item, InvalidItem):
+                results.append(schemas.BulkItemResult(index=index, detail=item.detail))
+                continue
+            try:
+                chunk_creates.append(schema.model_validate(item))
+                chunk_indexes.append(index)
+            except ValidationError as error:
+                results.append(schemas.BulkItemResult(index=index, detail=get_validation_detail(error)))
+        if not chunk_creates:
+            continue
+        try:
+            chunk_results: List[Tuple[Optional[int], Optional[str]]] = create_chunk(db, chunk_creates)
+        except IntegrityError:
+            db.rollback()
+            chunk_results = [(None, "Conflicting write, chunk rolled back")] * len(chunk_creates)
+        for index, (created_id, detail) in zip(chunk_indexes, chunk_results):
+            results.append(schemas.BulkItemResult(index=index, id=created_id, detail=detail))
+    results.sort(key=lambda result: result.index)
+    created: int = sum(1 for result in results if result.id is not None)
+    return schemas.BulkResult(created=created, failed=len(results) - created, items=results)
@@ -1,6 +1,42 @@
-from typing import List
-from sqlalchemy.orm import Session
-from . import models, schemas
+import os
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+import numpy as np
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import delete, func, insert
+from sqlalchemy.orm import Session, selectinload
+from . import finance, models, schemas
+from .lookup_cache import CACHE_MISS, lookup_cache
+
+
+# Materialize every loan's schedule into loan_schedule when it is created,
+# so schedule and summary reads become indexed lookups.
+PERSIST_SCHEDULES: bool = os.environ.get("LOAN_APP_PERSIST_SCHEDULES", "0") == "1"
+# Candidate loans checked per round trip when a balance filter has to be
+# verified against computed schedules.
+SEARCH_BATCH_SIZE: int = int(os.environ.get("LOAN_APP_SEARCH_BATCH_SIZE", "1000"))
+LOAN_SCHEDULE_COLUMNS: Tuple[str, ...] = (
+    "loan_id", "month", "interest_payment", "principal_payment", "monthly_payment",
+    "remaining_balance", "aggregate_principal_paid", "aggregate_interest_paid"
+)
+
+
+async def run(db, crud_function: Callable, *args, **kwargs):
+    # Awaitable form of any function in this module: on an AsyncSession it
+    # runs on the async connection via run_sync, on a sync Session it runs in
+    # the threadpool so the event loop is never blocked on the database.
+    if hasattr(db, "run_sync"):
+        return await db.run_sync(crud_function, *args, **kwargs)
+    return await run_in_threadpool(crud_function, db, *args, **kwargs)
+
+
+def paginate(query, id_column, skip: int, limit: int, after_id: Optional[int]):
+    # Keyset mode (after_id given) seeks on the primary key index, so every
+    # page costs the same no matter how deep it is; offset mode still scans
+    # past `skip` rows.
+    query = query.order_by(id_column)
+    if after_id is not None:
+        return query.filter(id_column > after_id).limit(limit).all()
+    return query.offset(skip).limit(limit).all()
 
 
 def get_user(db: Session, user_id: int):
@@ -11,8 +47,43 @@ def get_user_by_email(db: Session, email: str):
     return db.query(models.User).filter(models.User.email == email).first()
 
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
+def get_users_by_ids(db: Session, user_ids: List[int]):
+    return db.query(models.User).filter(models.User.id.in_(user_ids)).all()
+
+
+def get_cached_user(db: Session, user_id: int):
+    # Read-through get_user; the cached form is the plain User schema.
+    value = lookup_cache.get("user", user_id)
+    if value is CACHE_MISS:
+        db_user = get_user(db, user_id)
+        value = None if db_user is None else {"email": db_user.email, "id": db_user.id}
+        lookup_cache.set("user", user_id, value)
+    return None if value is None else schemas.User.model_construct(**value)
+
+
+def get_missing_user_ids(db: Session, user_ids: List[int]):
+    # Which of user_ids do not exist: answered from the cache where possible,
+    # with one IN query for the rest.
+    unknown_user_ids: List[int] = []
+    missing_user_ids: Set[int] = set()
+    for user_id in dict.fromkeys(user_ids):
+        value = lookup_cache.get("user", user_id)
+        if value is CACHE_MISS:
+            unknown_user_ids.append(user_id)
+        elif value is None:
+            missing_user_ids.add(user_id)
+    if unknown_user_ids:
+        db_users: Dict[int, models.User] = {db_user.id: db_user for db_user in get_users_by_ids(db, unknown_user_ids)}
+        for user_id in unknown_user_ids:
+            db_user = db_users.get(user_id)
+            lookup_cache.set("user", user_id, None if db_user is None else {"email": db_user.email, "id": db_user.id})
+            if db_user is None:
+                missing_user_ids.add(user_id)
+    return missing_user_ids
+
+
+def get_users(db: Session, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    return paginate(db.query(models.User), models.User.id, skip, limit, after_id)
 
 
 def create_user(db: Session, user: schemas.UserCreate):
@@ -20,31 +91,300 @@ def create_user(db: Session, user: schemas.UserCreate):
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    lookup_cache.invalidate("user", [db_user.id])
     return db_user
 
 
-def get_loans(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Loan).offset(skip).limit(limit).all()
+def create_users_bulk(db: Session, users: List[schemas.UserCreate]):
+    # One (id, detail) pair per user, in order: id when inserted, detail when
+    # rejected. Emails are checked against the table with a single query.
+    results: List[Tuple[Optional[int], Optional[str]]] = [(None, None)] * len(users)
+    emails: Set[str] = {user.email for user in users}
+    seen_emails: Set[str] = {
+        email for (email,) in db.query(models.User.email).filter(models.User.email.in_(emails))
+    }
+    rows: List[Dict] = []
+    row_indexes: List[int] = []
+    for index, user in enumerate(users):
+        if user.email in seen_emails:
+            results[index] = (None, "Email already registered")
+            continue
+        seen_emails.add(user.email)
+        rows.append({"email": user.email})
+        row_indexes.append(index)
+    if rows:
+        user_ids = db.scalars(
+            insert(models.User).returning(models.User.id, sort_by_parameter_order=True), rows
+        ).all()
+        db.commit()
+        lookup_cache.invalidate("user", user_ids)
+        for index, user_id in zip(row_indexes, user_ids):
+            results[index] = (user_id, None)
+    return results
+
+
+def get_loans(db: Session, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    query = db.query(models.Loan).options(selectinload(models.Loan.users))
+    return paginate(query, models.Loan.id, skip, limit, after_id)
+
+
+def get_loan_terms(db: Session, limit: int = 100, after_id: Optional[int] = None):
+    # Just the columns the finance engines need, without loading borrowers.
+    query = db.query(models.Loan.id, models.Loan.amount, models.Loan.rate, models.Loan.term)
+    return [finance.LoanTerms(*row) for row in paginate(query, models.Loan.id, 0, limit, after_id)]
 
 
-def get_loan(db:Session, loan_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.Loan).filter(models.Loan.id == loan_id).first()
+def get_loan_products(db: Session, user_id: Optional[int] = None, limit: Optional[int] = None):
+    # With a limit, only the products shared by the most loans.
+    loan_count = func.count(models.Loan.id)
+    query = db.query(models.Loan.amount, models.Loan.rate, models.Loan.term, loan_count)
+    if user_id is not None:
+        query = query.join(models.UserLoan, models.UserLoan.loan_id == models.Loan.id).filter(
+            models.UserLoan.user_id == user_id
+        )
+    query = query.group_by(models.Loan.amount, models.Loan.rate, models.Loan.term)
+    if limit is not None:
+        query = query.order_by(loan_count.desc(), models.Loan.amount, models.Loan.rate, models.Loan.term).limit(limit)
+    return [finance.LoanProduct(*row) for row in query]
+
+
+def get_loan_search_query(db: Session, columns: Sequence, search: schemas.LoanSearch, amount_min: Optional[int], amount_max: Optional[int]):
+    query = db.query(*columns)
+    id_column = models.Loan.id
+    if search.user_id is not None:
+        query = query.join(models.UserLoan, models.UserLoan.loan_id == models.Loan.id).filter(
+            models.UserLoan.user_id == search.user_id
+        )
+        id_column = models.UserLoan.loan_id
+    for column, minimum, maximum in (
+        (models.Loan.amount, amount_min, amount_max),
+        (models.Loan.rate, search.rate_min, search.rate_max),
+        (models.Loan.term, search.term_min, search.term_max)
+    ):
+        # Equal bounds become an equality, so the next index column can
+        # still be searched as a range.
+        if minimum is not None and minimum == maximum:
+            query = query.filter(column == minimum)
+            continue
+        if minimum is not None:
+            query = query.filter(column >= minimum)
+        if maximum is not None:
+            query = query.filter(column <= maximum)
+    return query, id_column
+
+
+def search_loans(db: Session, search: schemas.LoanSearch, limit: int = 100, after_id: Optional[int] = None):
+    # Range filters go to the composite loan indexes. A balance filter reads
+    # the persisted loan_schedule balance when schedules are materialized;
+    # otherwise it becomes an amount range (see
+    # finance.get_balance_amount_bounds) and the candidates' exact balances
+    # are checked a batch at a time until the page is full.
+    if search.balance_min is None and search.balance_max is None:
+        query, id_column = get_loan_search_query(db, [models.Loan], search, search.amount_min, search.amount_max)
+        return paginate(query.options(selectinload(models.Loan.users)), id_column, 0, limit, after_id)
+    if PERSIST_SCHEDULES:
+        query, id_column = get_loan_search_query(db, [models.Loan], search, search.amount_min, search.amount_max)
+        query = query.join(models.LoanScheduleMonth, models.LoanScheduleMonth.loan_id == models.Loan.id).filter(
+            models.LoanScheduleMonth.month == search.month + 1
+        )
+        if search.balance_min is not None:
+            query = query.filter(models.LoanScheduleMonth.remaining_balance >= search.balance_min)
+        if search.balance_max is not None:
+            query = query.filter(models.LoanScheduleMonth.remaining_balance <= search.balance_max)
+        return paginate(query.options(selectinload(models.Loan.users)), id_column, 0, limit, after_id)
+    amount_min, amount_max = finance.get_balance_amount_bounds(
+        search.month, search.balance_min, search.balance_max,
+        search.rate_min, search.rate_max, search.term_min, search.term_max
+    )
+    amount_min = max((bound for bound in (amount_min, search.amount_min) if bound is not None), default=None)
+    amount_max = min((bound for bound in (amount_max, search.amount_max) if bound is not None), default=None)
+    columns = [models.Loan.id, models.Loan.amount, models.Loan.rate, models.Loan.term]
+    query, id_column = get_loan_search_query(db, columns, search, amount_min, amount_max)
+    query = query.filter(models.Loan.term > search.month)
+    batch_size: int = max(limit, SEARCH_BATCH_SIZE)
+    loan_ids: List[int] = []
+    while len(loan_ids) < limit:
+        batch: List[finance.LoanTerms] = [finance.LoanTerms(*row) for row in paginate(query, id_column, 0, batch_size, after_id)]
+        balances: List[int] = finance.get_loan_balances(batch, search.month)
+        loan_ids.extend(
+            loan.id for loan, balance in zip(batch, balances)
+            if (search.balance_min is None or balance >= search.balance_min)
+            and (search.balance_max is None or balance <= search.balance_max)
+        )
+        if len(batch) < batch_size:
+            break
+        after_id = batch[-1].id
+    if not loan_ids:
+        return []
+    return db.query(models.Loan).filter(models.Loan.id.in_(loan_ids[:limit])).options(
+        selectinload(models.Loan.users)
+    ).order_by(models.Loan.id).all()
 
 
-def get_user_loans(db:Session, user_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.Loan).filter(models.Loan.users.any(models.User.id == user_id)).offset(skip).limit(limit).all()
+def get_loan(db:Session, loan_id: int, skip: int = 0, limit: int = 100, load_users: bool = True):
+    query = db.query(models.Loan).filter(models.Loan.id == loan_id)
+    if load_users:
+        query = query.options(selectinload(models.Loan.users))
+    return query.first()
+
+
+def get_cached_loan(db: Session, loan_id: int):
+    value = lookup_cache.get("loan", loan_id)
+    if value is CACHE_MISS:
+        db_loan = get_loan(db, loan_id=loan_id)
+        value = None if db_loan is None else {
+            "amount": db_loan.amount, "rate": db_loan.rate, "term": db_loan.term, "id": db_loan.id,
+            "users": [{"email": db_user.email, "id": db_user.id} for db_user in db_loan.users]
+        }
+        lookup_cache.set("loan", loan_id, value)
+    if value is None:
+        return None
+    users: List[schemas.User] = [schemas.User.model_construct(**user) for user in value["users"]]
+    return schemas.Loan.model_construct(**{**value, "users": users})
+
+
+def get_cached_loan_terms(db: Session, loan_id: int):
+    # What the schedule and summary math needs, without the borrowers.
+    value = lookup_cache.get("loan_terms", loan_id)
+    if value is CACHE_MISS:
+        db_loan = get_loan(db, loan_id=loan_id, load_users=False)
+        value = None if db_loan is None else [db_loan.id, db_loan.amount, db_loan.rate, db_loan.term]
+        lookup_cache.set("loan_terms", loan_id, value)
+    return None if value is None else finance.LoanTerms(*value)
+
+
+def get_loan_terms_by_ids(db: Session, loan_ids: List[int]):
+    query = db.query(models.Loan.id, models.Loan.amount, models.Loan.rate, models.Loan.term)
+    return [finance.LoanTerms(*row) for row in query.filter(models.Loan.id.in_(loan_ids))]
+
+
+def get_user_loans(db:Session, user_id: int, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    query = db.query(models.Loan).join(models.UserLoan, models.UserLoan.loan_id == models.Loan.id).filter(
+        models.UserLoan.user_id == user_id
+    ).options(selectinload(models.Loan.users))
+    # Ordering on user_loan.loan_id lets the (user_id, loan_id) primary key
+    # deliver rows already sorted, and seek straight to a cursor.
+    return paginate(query, models.UserLoan.loan_id, skip, limit, after_id)
 
 
 def create_user_loan(db:Session, loan_create: schemas.LoanCreate):
-    user_ids = loan_create.user_ids
-    db_users = db.query(models.User).filter(models.User.id.in_(user_ids)).all()
+    # Borrowers are linked by id, so callers validate user_ids first (see
+    # get_missing_user_ids) instead of loading User rows to attach.
     db_loan = models.Loan(
         amount=loan_create.amount,
         rate=loan_create.rate,
-        term=loan_create.term,
-        users=db_users
+        term=loan_create.term
     )
     db.add(db_loan)
+    db.flush()
+    loan_id: int = db_loan.id
+    db.execute(insert(models.UserLoan), [
+        {"user_id": user_id, "loan_id": loan_id} for user_id in dict.fromkeys(loan_create.user_ids)
+    ])
+    if PERSIST_SCHEDULES:
+        create_loan_schedules(db, [db_loan])
     db.commit()
-    db.refresh(db_loan)
-    return db_loan
+    lookup_cache.invalidate("loan", [loan_id])
+    lookup_cache.invalidate("loan_terms", [loan_id])
+    return get_loan(db, loan_id=loan_id)
+
+
+def create_user_loans_bulk(db: Session, loan_creates: List[schemas.LoanCreate]):
+    # Same contract as create_users_bulk; borrowers are validated with one
+    # query and the loan and user_loan rows go in as two executemany inserts.
+    results: List[Tuple[Optional[int], Optional[str]]] = [(None, None)] * len(loan_creates)
+    user_ids: Set[int] = {user_id for loan_create in loan_creates for user_id in loan_create.user_ids}
+    existing_user_ids: Set[int] = {
+        user_id for (user_id,) in db.query(models.User.id).filter(models.User.id.in_(user_ids))
+    }
+    rows: List[Dict] = []
+    row_indexes: List[int] = []
+    for index, loan_create in enumerate(loan_creates):
+        if len(loan_create.user_ids) < 1:
+            results[index] = (None, "No user_ids provided")
+        elif not existing_user_ids.issuperset(loan_create.user_ids):
+            results[index] = (None, "User not found")
+        else:
+            rows.append({"amount": loan_create.amount, "rate": loan_create.rate, "term": loan_create.term})
+            row_indexes.append(index)
+    if rows:
+        loan_ids = db.scalars(
+            insert(models.Loan).returning(models.Loan.id, sort_by_parameter_order=True), rows
+        ).all()
+        user_loan_rows: List[Dict] = [
+            {"user_id": user_id, "loan_id": loan_id}
+            for index, loan_id in zip(row_indexes, loan_ids)
+            for user_id in dict.fromkeys(loan_creates[index].user_ids)
+        ]
+        db.execute(insert(models.UserLoan), user_loan_rows)
+        if PERSIST_SCHEDULES:
+            create_loan_schedules(db, [
+                schemas.Loan.model_construct(id=loan_id, **row) for loan_id, row in zip(loan_ids, rows)
+            ])
+        db.commit()
+        lookup_cache.invalidate("loan", loan_ids)
+        lookup_cache.invalidate("loan_terms", loan_ids)
+        for index, loan_id in zip(row_indexes, loan_ids):
+            results[index] = (loan_id, None)
+    return results
+
+
+def create_loan_schedules(db: Session, loans: Sequence[schemas.Loan]):
+    portfolio_schedules = finance.get_portfolio_schedules(loans)
+    aggregate_principal_paid: np.ndarray = np.cumsum(portfolio_schedules.principal_payment, axis=1)
+    aggregate_interest_paid: np.ndarray = np.cumsum(portfolio_schedules.interest_payment, axis=1)
+    loan_indexes, month_indexes = np.nonzero(portfolio_schedules.mask)
+    columns = zip(
+        portfolio_schedules.loan_id[loan_indexes].tolist(),
+        (month_indexes + 1).tolist(),
+        *(
+            values[loan_indexes, month_indexes].tolist()
+            for values in (
+                portfolio_schedules.interest_payment,
+                portfolio_schedules.principal_payment,
+                portfolio_schedules.monthly_payment,
+                portfolio_schedules.remaining_balance,
+                aggregate_principal_paid,
+                aggregate_interest_paid
+            )
+        )
+    )
+    schedule_rows: List[Dict] = [dict(zip(LOAN_SCHEDULE_COLUMNS, values)) for values in columns]
+    if schedule_rows:
+        db.execute(insert(models.LoanScheduleMonth), schedule_rows)
+
+
+def delete_loan_schedules(db: Session):
+    db.execute(delete(models.LoanScheduleMonth))
+
+
+def get_loan_schedule(db: Session, loan_id: int):
+    return db.query(
+        models.LoanScheduleMonth.month,
+        models.LoanScheduleMonth.interest_payment,
+        models.LoanScheduleMonth.principal_payment,
+        models.LoanScheduleMonth.monthly_payment,
+        models.LoanScheduleMonth.remaining_balance
+    ).filter(models.LoanScheduleMonth.loan_id == loan_id).order_by(models.LoanScheduleMonth.month).all()
+
+
+def get_loan_summary(db: Session, loan_id: int, month: int):
+    # Same figures as finance.get_loan_summary: the balance at schedule index
+    # `month` (month number month + 1) and the payments at indexes 1..month,
+    # i.e. the running totals at month + 1 less those at month 1.
+    db_months = db.query(models.LoanScheduleMonth).filter(
+        models.LoanScheduleMonth.loan_id == loan_id,
+        models.LoanScheduleMonth.month.in_((1, month + 1))
+    ).all()
+    months: Dict[int, models.LoanScheduleMonth] = {db_month.month: db_month for db_month in db_months}
+    if 1 not in months or month + 1 not in months:
+        return None
+    first_month: models.LoanScheduleMonth = months[1]
+    curr_month: models.LoanScheduleMonth = months[month + 1]
+    return schemas.LoanSummary(
+        loan_id=loan_id,
+        month=month,
+        principal_balance=curr_month.remaining_balance,
+        aggregate_principal_paid=curr_month.aggregate_principal_paid - first_month.aggregate_principal_paid,
+        aggregate_interest_paid=curr_month.aggregate_interest_paid - first_month.aggregate_interest_paid
+    )
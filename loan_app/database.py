@@ -1,12 +1,129 @@
-from sqlalchemy import create_engine
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, List
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.pool import StaticPool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 #DATABASE_URL = "sqlite:///./loan_app.db"
-DATABASE_URL = "sqlite:///:memory:"
-engine = create_engine(
- DATABASE_URL, connect_args={"check_same_thread": False}, poolclass=StaticPool
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+DATABASE_URL = os.environ.get("LOAN_APP_DATABASE_URL", "sqlite:///:memory:")
+# e.g. "sqlite+aiosqlite:///./loan_app.db"; leave unset to serve requests with
+# the sync engine above.
+ASYNC_DATABASE_URL = os.environ.get("LOAN_APP_ASYNC_DATABASE_URL")
+DATABASE_POOL_SIZE = int(os.environ.get("LOAN_APP_DATABASE_POOL_SIZE", "5"))
+DATABASE_MAX_OVERFLOW = int(os.environ.get("LOAN_APP_DATABASE_MAX_OVERFLOW", "10"))
+# Applied on every new connection to a file-backed SQLite database. WAL lets
+# readers run alongside the single writer, and synchronous=NORMAL is safe
+# under WAL (a crash can lose the last commits, never corrupt the file).
+SQLITE_PRAGMAS: Dict[str, str] = {
+    "journal_mode": os.environ.get("LOAN_APP_SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("LOAN_APP_SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": os.environ.get("LOAN_APP_SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),
+    # Negative values are KiB, so this is a 64 MiB page cache per connection.
+    "cache_size": os.environ.get("LOAN_APP_SQLITE_CACHE_SIZE", str(-64 * 1024)),
+    "busy_timeout": os.environ.get("LOAN_APP_SQLITE_BUSY_TIMEOUT", "5000"),
+    "temp_store": "MEMORY"
+}
+
+
+def is_sqlite_file(url: str):
+    database_url = make_url(url)
+    return database_url.get_backend_name() == "sqlite" and database_url.database not in (None, "", ":memory:")
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+def get_engine_options(url: str):
+    database_url = make_url(url)
+    is_sqlite: bool = database_url.get_backend_name() == "sqlite"
+    if is_sqlite and not is_sqlite_file(url):
+        # An in-memory database only exists on its one connection.
+        return {"connect_args": {"check_same_thread": False}, "poolclass": StaticPool}
+    options = {"pool_size": DATABASE_POOL_SIZE, "max_overflow": DATABASE_MAX_OVERFLOW, "pool_pre_ping": True}
+    if is_sqlite:
+        options["connect_args"] = {"check_same_thread": False}
+    return options
+
+
+def create_database_engine(url: str):
+    database_engine = create_engine(url, **get_engine_options(url))
+    if is_sqlite_file(url):
+        event.listen(database_engine, "connect", set_sqlite_pragmas)
+    return database_engine
+
+
+# Engines and session factories are created on first use rather than at
+# import, so importing the app (tests, tooling, a worker before its lifespan
+# runs) neither loads database drivers nor needs the database to be up.
+_engines: Dict[str, Any] = {}
+_engines_lock: threading.Lock = threading.Lock()
+
+
+def create_engines():
+    engines: Dict[str, Any] = {"engine": create_database_engine(DATABASE_URL)}
+    engines["SessionLocal"] = sessionmaker(autocommit=False, autoflush=False, bind=engines["engine"])
+    engines["async_engine"] = None
+    engines["AsyncSessionLocal"] = None
+    if ASYNC_DATABASE_URL:
+        # Needs the sqlalchemy[asyncio] extra and an async driver such as aiosqlite.
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+        async_engine = create_async_engine(ASYNC_DATABASE_URL, **get_engine_options(ASYNC_DATABASE_URL))
+        if is_sqlite_file(ASYNC_DATABASE_URL):
+            event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+        engines["async_engine"] = async_engine
+        engines["AsyncSessionLocal"] = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+    return engines
+
+
+def get_engines():
+    if not _engines:
+        with _engines_lock:
+            if not _engines:
+                _engines.update(create_engines())
+    return _engines
+
+
+def __getattr__(name: str):
+    # engine, SessionLocal, async_engine and AsyncSessionLocal are looked up
+    # here, so they must be read as database.<name> at call time rather than
+    # imported by name.
+    if name in ("engine", "SessionLocal", "async_engine", "AsyncSessionLocal"):
+        return get_engines()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 Base = declarative_base()
+
+
+class QueryCounter:
+    def __init__(self):
+        self.statements: List[str] = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+@contextmanager
+def count_queries(bind=None):
+    # Records every statement sent to the database on `bind` (the default
+    # engine unless given; pass AsyncEngine.sync_engine for the async one).
+    bind = get_engines()["engine"] if bind is None else bind
+    query_counter = QueryCounter()
+
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        query_counter.statements.append(statement)
+
+    event.listen(bind, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield query_counter
+    finally:
+        event.remove(bind, "before_cursor_execute", before_cursor_execute)
@@ -1,56 +1,578 @@
-from typing import List
-from decimal import Decimal
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from math import ceil, floor, gcd
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+import numpy as np
 from . import schemas
 
 
-def get_pmt(principal: int, rate: int, term: int):
-    n: int = 12
-    r: Decimal = rate / 10000
-    pmt_Decimal: Decimal = (
-        ( principal * (r/n) )
-        /( 1 - ( 1 / ( ( 1 + (r/n) )**term ) ) )
+# Bump whenever a rule change alters computed figures: it is part of every
+# schedule and summary ETag, so clients and proxies refetch.
+FINANCE_VERSION: str = "1"
+SCHEDULE_CACHE_SIZE: int = int(os.environ.get("LOAN_APP_SCHEDULE_CACHE_SIZE", "4096"))
+SCHEDULE_CACHE_BYTES: int = int(os.environ.get("LOAN_APP_SCHEDULE_CACHE_BYTES", str(64 * 1024 * 1024)))
+MAX_SCENARIOS: int = int(os.environ.get("LOAN_APP_MAX_SCENARIOS", "1000"))
+MAX_BALANCE_MONTHS: int = int(os.environ.get("LOAN_APP_MAX_BALANCE_MONTHS", "600"))
+ANNUITY_FACTOR_CACHE_SIZE: int = 65536
+ANNUITY_FACTOR_BITS: int = 128
+ANNUITY_FACTOR_MASK: int = (1 << ANNUITY_FACTOR_BITS) - 1
+ANNUITY_FACTOR_HALF: int = 1 << (ANNUITY_FACTOR_BITS - 1)
+
+
+class LoanTerms(NamedTuple):
+    id: int
+    amount: int
+    rate: int
+    term: int
+
+
+class LoanProduct(NamedTuple):
+    amount: int
+    rate: int
+    term: int
+    count: int
+
+
+class CashflowColumns(NamedTuple):
+    month: np.ndarray
+    interest_payment: np.ndarray
+    principal_payment: np.ndarray
+    total_payment: np.ndarray
+    remaining_balance: np.ndarray
+
+
+class LoanScheduleRow(NamedTuple):
+    month: int
+    interest_payment: int
+    principal_payment: int
+    monthly_payment: int
+    remaining_balance: int
+
+
+class LoanSchedule:
+    # A schedule as one int64 array per stored column instead of a list of
+    # LoanScheduleMonth models; month and monthly_payment are derived, and
+    # the running totals are kept so any month's summary is two lookups.
+    # Slices are views that share the arrays of the schedule they came from.
+    __slots__ = (
+        "start_month", "interest_payment", "principal_payment", "remaining_balance",
+        "aggregate_interest_paid", "aggregate_principal_paid"
     )
-    pmt: int = int(round(pmt_Decimal, 0))
+
+    def __init__(
+        self,
+        interest_payment: np.ndarray,
+        principal_payment: np.ndarray,
+        remaining_balance: np.ndarray,
+        aggregate_interest_paid: Optional[np.ndarray] = None,
+        aggregate_principal_paid: Optional[np.ndarray] = None,
+        start_month: int = 1
+    ):
+        self.start_month: int = start_month
+        self.interest_payment: np.ndarray = interest_payment
+        self.principal_payment: np.ndarray = principal_payment
+        self.remaining_balance: np.ndarray = remaining_balance
+        self.aggregate_interest_paid: np.ndarray = (
+            np.cumsum(interest_payment) if aggregate_interest_paid is None else aggregate_interest_paid
+        )
+        self.aggregate_principal_paid: np.ndarray = (
+            np.cumsum(principal_payment) if aggregate_principal_paid is None else aggregate_principal_paid
+        )
+
+    @property
+    def month(self):
+        return np.arange(self.start_month, self.start_month + len(self), dtype=np.int64)
+
+    @property
+    def monthly_payment(self):
+        return self.interest_payment + self.principal_payment
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in LoanSchedule.__slots__[1:])
+
+    def __len__(self):
+        return len(self.interest_payment)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("LoanSchedule slices must be contiguous")
+            return LoanSchedule(
+                *(getattr(self, name)[start:stop] for name in LoanSchedule.__slots__[1:]),
+                start_month=self.start_month + start
+            )
+        index: int = range(len(self))[key]
+        interest_payment: int = int(self.interest_payment[index])
+        principal_payment: int = int(self.principal_payment[index])
+        return LoanScheduleRow(
+            self.start_month + index, interest_payment, principal_payment,
+            interest_payment + principal_payment, int(self.remaining_balance[index])
+        )
+
+    def __iter__(self):
+        return map(LoanScheduleRow._make, zip(*(column.tolist() for column in self.columns())))
+
+    def columns(self):
+        return (self.month, self.interest_payment, self.principal_payment, self.monthly_payment, self.remaining_balance)
+
+    def set_read_only(self):
+        for name in LoanSchedule.__slots__[1:]:
+            getattr(self, name).flags.writeable = False
+
+    def to_dict(self):
+        return dict(zip(LoanScheduleRow._fields, self.columns()))
+
+    def to_numpy(self):
+        # (month x field) array, fields in LoanScheduleRow order.
+        return np.column_stack(self.columns())
+
+    def to_rows(self):
+        return [dict(zip(LoanScheduleRow._fields, row)) for row in zip(*(column.tolist() for column in self.columns()))]
+
+    def to_schema(self):
+        return [schemas.LoanScheduleMonth(**row) for row in self.to_rows()]
+
+
+class PortfolioScheduleColumns(NamedTuple):
+    loan_id: np.ndarray
+    term: np.ndarray
+    mask: np.ndarray
+    interest_payment: np.ndarray
+    principal_payment: np.ndarray
+    monthly_payment: np.ndarray
+    remaining_balance: np.ndarray
+
+    def get_loan_schedule_columns(self, index: int):
+        term: int = int(self.term[index])
+        return LoanSchedule(
+            interest_payment=self.interest_payment[index, :term],
+            principal_payment=self.principal_payment[index, :term],
+            remaining_balance=self.remaining_balance[index, :term]
+        )
+
+
+def div_round_half_even(numerator: int, denominator: int):
+    # Integer numerator / denominator rounded half to even (banker's
+    # rounding), the mode both the old float round() and Decimal used.
+    quotient, remainder = divmod(numerator, denominator)
+    twice_remainder: int = 2 * remainder
+    if twice_remainder > denominator or (twice_remainder == denominator and quotient & 1):
+        quotient += 1
+    return quotient
+
+
+@lru_cache(maxsize=ANNUITY_FACTOR_CACHE_SIZE)
+def get_annuity_factor(rate: int, term: int):
+    # pmt / principal = (r/n) / (1 - (1 + r/n)**-term) with r/n = rate / 120000,
+    # kept as an exact reduced fraction so (1 + r/n)**term is only raised
+    # once per (rate, term) product, plus the same ratio floored to a
+    # 2**-ANNUITY_FACTOR_BITS fixed point for the fast path in get_pmt.
+    if rate == 0:
+        numerator, denominator = 1, term
+    else:
+        growth: int = (120000 + rate) ** term
+        numerator = rate * growth
+        denominator = 120000 * (growth - 120000 ** term)
+        common_divisor: int = gcd(numerator, denominator)
+        numerator //= common_divisor
+        denominator //= common_divisor
+    return numerator, denominator, (numerator << ANNUITY_FACTOR_BITS) // denominator
+
+
+def get_pmt(principal: int, rate: int, term: int):
+    return get_pmt_from_factor(principal, get_annuity_factor(rate, term))
+
+
+def get_pmt_from_factor(principal: int, annuity_factor: Tuple[int, int, int]):
+    numerator, denominator, fixed_point_factor = annuity_factor
+    # The fixed-point product undershoots the exact one by less than
+    # `principal` units of 2**-ANNUITY_FACTOR_BITS, so unless the fraction
+    # lands within that much of .5 (or of the next integer) it rounds the
+    # same way; otherwise settle it with the exact fraction.
+    scaled_pmt: int = principal * fixed_point_factor
+    pmt: int = scaled_pmt >> ANNUITY_FACTOR_BITS
+    fraction: int = scaled_pmt & ANNUITY_FACTOR_MASK
+    if principal >= 0:
+        if fraction + principal < ANNUITY_FACTOR_HALF:
+            return pmt
+        if fraction > ANNUITY_FACTOR_HALF and fraction + principal <= ANNUITY_FACTOR_MASK:
+            return pmt + 1
+    pmt = div_round_half_even(principal * numerator, denominator)
     return pmt
 
 
 def get_curr_interest_payment(remaining_balance: int, rate: int):
-    curr_interest_payment_Decimal: Decimal = Decimal(remaining_balance * rate) / 120000
-    curr_interest_payment: int = int(round(curr_interest_payment_Decimal, 0))
+    # div_round_half_even(remaining_balance * rate, 120000), inlined because
+    # it runs once per month of every schedule.
+    curr_interest_payment, remainder = divmod(remaining_balance * rate + 60000, 120000)
+    if remainder == 0 and curr_interest_payment & 1:
+        curr_interest_payment -= 1
     return curr_interest_payment
 
 
+def get_loan_schedule_columns(amount: int, rate: int, term: int):
+    monthly_payment: int = get_pmt(amount, rate, term)
+    interest_payments: List[int] = [0] * term
+    remaining_balances: List[int] = [0] * term
+    remaining_balance: int = amount
+    for index in range(term):
+        curr_interest_payment: int = get_curr_interest_payment(remaining_balance, rate)
+        interest_payments[index] = curr_interest_payment
+        remaining_balance -= monthly_payment - curr_interest_payment
+        remaining_balances[index] = remaining_balance
+    interest_payment: np.ndarray = np.array(interest_payments, dtype=np.int64)
+    principal_payment: np.ndarray = monthly_payment - interest_payment
+    remaining_balance_column: np.ndarray = np.array(remaining_balances, dtype=np.int64)
+    if term > 0:
+        principal_payment[-1] += remaining_balance_column[-1]
+        remaining_balance_column[-1] = 0
+    return LoanSchedule(
+        interest_payment=interest_payment,
+        principal_payment=principal_payment,
+        remaining_balance=remaining_balance_column
+    )
+
+
+def get_portfolio_schedules(loans: Sequence[schemas.Loan]):
+    # Amortizes every loan at once as (loan x month) arrays padded to the
+    # longest term; mask marks the months that fall inside each loan's term.
+    loan_count: int = len(loans)
+    loan_ids: np.ndarray = np.fromiter((loan.id for loan in loans), dtype=np.int64, count=loan_count)
+    amounts: np.ndarray = np.fromiter((loan.amount for loan in loans), dtype=np.int64, count=loan_count)
+    rates: np.ndarray = np.fromiter((loan.rate for loan in loans), dtype=np.int64, count=loan_count)
+    terms: np.ndarray = np.fromiter((loan.term for loan in loans), dtype=np.int64, count=loan_count)
+    monthly_payments: np.ndarray = np.fromiter(
+        (get_pmt(loan.amount, loan.rate, loan.term) for loan in loans), dtype=np.int64, count=loan_count
+    )
+    max_term: int = int(terms.max()) if loan_count else 0
+    interest_payment: np.ndarray = np.zeros((max_term, loan_count), dtype=np.int64)
+    remaining_balance: np.ndarray = np.zeros((max_term, loan_count), dtype=np.int64)
+    curr_remaining_balance: np.ndarray = amounts.copy()
+    for index in range(max_term):
+        active: np.ndarray = terms > index
+        curr_interest_payment, remainder = np.divmod(curr_remaining_balance * rates + 60000, 120000)
+        curr_interest_payment -= (remainder == 0) & (curr_interest_payment & 1 == 1)
+        curr_interest_payment *= active
+        curr_remaining_balance -= (monthly_payments - curr_interest_payment) * active
+        interest_payment[index] = curr_interest_payment
+        remaining_balance[index] = curr_remaining_balance
+    interest_payment = np.ascontiguousarray(interest_payment.T)
+    remaining_balance = np.ascontiguousarray(remaining_balance.T)
+    mask: np.ndarray = np.arange(1, max_term + 1, dtype=np.int64) <= terms[:, np.newaxis]
+    monthly_payment: np.ndarray = np.where(mask, monthly_payments[:, np.newaxis], 0)
+    principal_payment: np.ndarray = monthly_payment - interest_payment
+    rows: np.ndarray = np.flatnonzero(terms > 0)
+    last_months: np.ndarray = terms[rows] - 1
+    final_balances: np.ndarray = remaining_balance[rows, last_months]
+    monthly_payment[rows, last_months] += final_balances
+    principal_payment[rows, last_months] += final_balances
+    remaining_balance[~mask] = 0
+    remaining_balance[rows, last_months] = 0
+    return PortfolioScheduleColumns(
+        loan_id=loan_ids,
+        term=terms,
+        mask=mask,
+        interest_payment=interest_payment,
+        principal_payment=principal_payment,
+        monthly_payment=monthly_payment,
+        remaining_balance=remaining_balance
+    )
+
+
+def get_portfolio_cashflows(products: Sequence[LoanProduct]):
+    # Month-by-month totals across a portfolio: every distinct product is
+    # amortized once and weighted by how many loans share it, so the whole
+    # projection is one (products x month) pass and one matrix product.
+    portfolio_schedules = get_portfolio_schedules([
+        LoanTerms(index, product.amount, product.rate, product.term) for index, product in enumerate(products)
+    ])
+    counts: np.ndarray = np.fromiter((product.count for product in products), dtype=np.int64, count=len(products))
+    max_term: int = portfolio_schedules.mask.shape[1]
+    return CashflowColumns(
+        month=np.arange(1, max_term + 1, dtype=np.int64),
+        interest_payment=counts @ portfolio_schedules.interest_payment,
+        principal_payment=counts @ portfolio_schedules.principal_payment,
+        total_payment=counts @ portfolio_schedules.monthly_payment,
+        remaining_balance=counts @ portfolio_schedules.remaining_balance
+    )
+
+
+def add_cashflows(cashflows: Sequence[CashflowColumns]):
+    max_term: int = max((len(columns.month) for columns in cashflows), default=0)
+    totals: List[np.ndarray] = [np.zeros(max_term, dtype=np.int64) for _ in CashflowColumns._fields]
+    for columns in cashflows:
+        for total, column in zip(totals, columns):
+            total[:len(column)] += column
+    totals[0] = np.arange(1, max_term + 1, dtype=np.int64)
+    return CashflowColumns(*totals)
+
+
+def get_cashflow_rows(columns: CashflowColumns):
+    return [dict(zip(CashflowColumns._fields, row)) for row in zip(*(column.tolist() for column in columns))]
+
+
+class ScenarioColumns(NamedTuple):
+    # One entry per scenario; months that never happen are stored as 0.
+    extra_principal: np.ndarray
+    extra_principal_start_month: np.ndarray
+    lump_sum: np.ndarray
+    lump_sum_month: np.ndarray
+    rate_reset_month: np.ndarray
+    reset_rate: np.ndarray
+    payoff_month: np.ndarray
+
+
+class ScenarioTotals(NamedTuple):
+    total_interest: np.ndarray
+    total_principal: np.ndarray
+    payoff_month: np.ndarray
+    balances: np.ndarray
+
+    def get_loan_totals(self, index: int):
+        return ScenarioTotals(*(column[index] for column in self))
+
+
+def get_scenario_columns(scenarios: Sequence[schemas.LoanScenario]):
+    # Scenario 0 is always the unchanged schedule the deltas are measured
+    # against.
+    rows: List[Tuple[int, ...]] = [(0, 0, 0, 0, 0, 0, 0)] + [(
+        scenario.extra_principal, scenario.extra_principal_start_month, scenario.lump_sum, scenario.lump_sum_month,
+        scenario.rate_reset_month or 0, scenario.reset_rate or 0, scenario.payoff_month or 0
+    ) for scenario in scenarios]
+    columns: np.ndarray = np.array(rows, dtype=np.int64).T
+    return ScenarioColumns(*(np.ascontiguousarray(column) for column in columns))
+
+
+def get_pmts(principals: np.ndarray, rates: np.ndarray, terms: np.ndarray):
+    # get_pmt over arrays: each distinct (rate, term) factor is computed
+    # once and applied in float64, whose relative error is a few 1e-16, so
+    # only products landing within 1e-12 of .5 are settled with the exact
+    # integer get_pmt.
+    if len(principals) == 0:
+        return np.zeros(0, dtype=np.int64)
+    products, inverse = np.unique(np.stack([rates, terms]), axis=1, return_inverse=True)
+    factors: np.ndarray = np.array([
+        numerator / denominator
+        for numerator, denominator, _ in (get_annuity_factor(int(rate), int(term)) for rate, term in products.T)
+    ])
+    scaled_pmts: np.ndarray = principals * factors[inverse.reshape(-1)]
+    pmts: np.ndarray = np.rint(scaled_pmts).astype(np.int64)
+    ambiguous: np.ndarray = np.abs(scaled_pmts - np.floor(scaled_pmts) - 0.5) <= np.abs(scaled_pmts) * 1e-12 + 1e-12
+    for index in np.flatnonzero(ambiguous).tolist():
+        pmts[index] = get_pmt(int(principals[index]), int(rates[index]), int(terms[index]))
+    return pmts
+
+
+def get_scenario_totals(loans: Sequence, scenario_columns: ScenarioColumns, balance_months: Sequence[int]):
+    # Runs every scenario against every loan as one vector of (loan x
+    # scenario) lanes, stepping all lanes a month at a time with the same
+    # integer interest rounding as get_portfolio_schedules. Each month the
+    # payment is the scheduled one plus any extra principal and lump sum,
+    # capped at the balance; a rate reset re-amortizes the balance over the
+    # rest of the original term, and a payoff month settles the balance in
+    # full. Results are (loan x scenario) arrays, balances (loan x scenario
+    # x balance_months) as of the end of each requested month.
+    loan_count: int = len(loans)
+    scenario_count: int = len(scenario_columns.extra_principal)
+    lane_count: int = loan_count * scenario_count
+    amounts: np.ndarray = np.fromiter((loan.amount for loan in loans), dtype=np.int64, count=loan_count)
+    rates: np.ndarray = np.fromiter((loan.rate for loan in loans), dtype=np.int64, count=loan_count)
+    terms: np.ndarray = np.fromiter((loan.term for loan in loans), dtype=np.int64, count=loan_count)
+    monthly_payments: np.ndarray = np.fromiter(
+        (get_pmt(loan.amount, loan.rate, loan.term) for loan in loans), dtype=np.int64, count=loan_count
+    )
+    scenario_lanes: ScenarioColumns = ScenarioColumns(*(np.tile(column, loan_count) for column in scenario_columns))
+    term: np.ndarray = np.repeat(terms, scenario_count)
+    payoff_month: np.ndarray = scenario_lanes.payoff_month
+    # Lanes that have paid off are dropped from these working arrays as
+    # they accumulate; `lanes` maps what is left back to the output rows.
+    lanes: np.ndarray = np.arange(lane_count)
+    state: Dict[str, np.ndarray] = {
+        "remaining_balance": np.repeat(amounts, scenario_count),
+        "rate": np.repeat(rates, scenario_count),
+        "term": term,
+        "monthly_payment": np.repeat(monthly_payments, scenario_count),
+        "last_month": np.where((payoff_month > 0) & (payoff_month < term), payoff_month, term),
+        "curr_extra_principal": np.zeros(lane_count, dtype=np.int64),
+        "total_interest": np.zeros(lane_count, dtype=np.int64),
+        "total_principal": np.zeros(lane_count, dtype=np.int64),
+        "paid_off_month": np.zeros(lane_count, dtype=np.int64),
+        **{field: column for field, column in zip(ScenarioColumns._fields, scenario_lanes)}
+    }
+    total_interest: np.ndarray = np.zeros(lane_count, dtype=np.int64)
+    total_principal: np.ndarray = np.zeros(lane_count, dtype=np.int64)
+    paid_off_month: np.ndarray = np.zeros(lane_count, dtype=np.int64)
+    balances: np.ndarray = np.zeros((lane_count, len(balance_months)), dtype=np.int64)
+    balance_columns: Dict[int, List[int]] = {}
+    for index, month in enumerate(balance_months):
+        balance_columns.setdefault(month, []).append(index)
+    if 0 in balance_columns:
+        balances[:, balance_columns[0]] = state["remaining_balance"][:, np.newaxis]
+    # Per-lane events only need checking in the months some scenario uses.
+    extra_principal_months: set = set(scenario_columns.extra_principal_start_month[scenario_columns.extra_principal != 0].tolist())
+    lump_sum_months: set = set(scenario_columns.lump_sum_month[scenario_columns.lump_sum != 0].tolist())
+    rate_reset_months: set = set(scenario_columns.rate_reset_month.tolist()) - {0}
+    last_months: set = set(state["last_month"].tolist())
+    max_term: int = max(last_months, default=0)
+
+    def store(rows: np.ndarray):
+        total_interest[lanes[rows]] = state["total_interest"][rows]
+        total_principal[lanes[rows]] = state["total_principal"][rows]
+        paid_off_month[lanes[rows]] = state["paid_off_month"][rows]
+
+    for month in range(1, max_term + 1):
+        remaining_balance: np.ndarray = state["remaining_balance"]
+        if month in extra_principal_months:
+            starting: np.ndarray = state["extra_principal_start_month"] == month
+            state["curr_extra_principal"][starting] = state["extra_principal"][starting]
+        if month in rate_reset_months:
+            resetting: np.ndarray = (state["rate_reset_month"] == month) & (state["paid_off_month"] == 0)
+            state["rate"][resetting] = state["reset_rate"][resetting]
+            state["monthly_payment"][resetting] = get_pmts(
+                remaining_balance[resetting], state["rate"][resetting], state["term"][resetting] - month + 1
+            )
+        curr_interest_payment, remainder = np.divmod(remaining_balance * state["rate"] + 60000, 120000)
+        curr_interest_payment -= (remainder == 0) & (curr_interest_payment & 1 == 1)
+        curr_principal_payment: np.ndarray = state["monthly_payment"] - curr_interest_payment
+        curr_principal_payment += state["curr_extra_principal"]
+        if month in lump_sum_months:
+            curr_principal_payment += state["lump_sum"] * (state["lump_sum_month"] == month)
+        # A paid-off lane has no balance and no interest left, so it keeps
+        # "closing" on a zero payment until it is compacted away.
+        closing: np.ndarray = curr_principal_payment >= remaining_balance
+        if month in last_months:
+            closing |= state["last_month"] == month
+        np.copyto(curr_principal_payment, remaining_balance, where=closing)
+        remaining_balance -= curr_principal_payment
+        state["total_interest"] += curr_interest_payment
+        state["total_principal"] += curr_principal_payment
+        paid_off: np.ndarray = state["paid_off_month"]
+        paid_off[closing & (paid_off == 0)] = month
+        if month in balance_columns:
+            balances[lanes[:, np.newaxis], balance_columns[month]] = remaining_balance[:, np.newaxis]
+        open_lanes: np.ndarray = paid_off == 0
+        open_count: int = int(np.count_nonzero(open_lanes))
+        if open_count <= len(lanes) * 3 // 4:
+            store(np.flatnonzero(~open_lanes))
+            lanes = lanes[open_lanes]
+            state = {field: column[open_lanes] for field, column in state.items()}
+            if open_count == 0:
+                break
+    store(np.arange(len(lanes)))
+    return ScenarioTotals(
+        total_interest=total_interest.reshape(loan_count, scenario_count),
+        total_principal=total_principal.reshape(loan_count, scenario_count),
+        payoff_month=paid_off_month.reshape(loan_count, scenario_count),
+        balances=balances.reshape(loan_count, scenario_count, len(balance_months))
+    )
+
+
+def get_portfolio_scenario_totals(products: Sequence[LoanProduct], scenario_columns: ScenarioColumns, balance_months: Sequence[int]):
+    # Like get_portfolio_cashflows, each distinct product runs once and is
+    # weighted by its loan count; payoff_month is the last loan to pay off.
+    totals: ScenarioTotals = get_scenario_totals(products, scenario_columns, balance_months)
+    counts: np.ndarray = np.fromiter((product.count for product in products), dtype=np.int64, count=len(products))
+    return ScenarioTotals(
+        total_interest=counts @ totals.total_interest,
+        total_principal=counts @ totals.total_principal,
+        payoff_month=totals.payoff_month.max(axis=0, initial=0),
+        balances=np.tensordot(counts, totals.balances, axes=1)
+    )
+
+
+def add_scenario_totals(totals: Sequence[ScenarioTotals]):
+    return ScenarioTotals(
+        total_interest=sum(scenario_totals.total_interest for scenario_totals in totals),
+        total_principal=sum(scenario_totals.total_principal for scenario_totals in totals),
+        payoff_month=np.max([scenario_totals.payoff_month for scenario_totals in totals], axis=0),
+        balances=sum(scenario_totals.balances for scenario_totals in totals)
+    )
+
+
+def get_scenario_results(totals: ScenarioTotals, scenarios: Sequence[schemas.LoanScenario], outputs: Sequence[str]):
+    # Only the requested outputs are filled in; deltas are against the
+    # unchanged schedule in slot 0.
+    def get_result(index: int, name: Optional[str]):
+        values: Dict = {
+            "total_interest": int(totals.total_interest[index]),
+            "total_principal": int(totals.total_principal[index]),
+            "payoff_month": int(totals.payoff_month[index]),
+            "interest_delta": int(totals.total_interest[index] - totals.total_interest[0]),
+            "payoff_month_delta": int(totals.payoff_month[index] - totals.payoff_month[0]),
+            "balances": totals.balances[index].tolist()
+        }
+        return schemas.ScenarioResult.model_construct(name=name, **{output: values[output] for output in outputs})
+
+    return schemas.ScenarioResults.model_construct(
+        base=get_result(0, None),
+        scenarios=[get_result(index, scenario.name) for index, scenario in enumerate(scenarios, start=1)]
+    )
+
+
+def iter_loan_schedule(amount: int, rate: int, term: int):
+    # Generator form of get_loan_schedule: one (month, interest_payment,
+    # principal_payment, monthly_payment, remaining_balance) tuple at a time.
+    monthly_payment: int = get_pmt(amount, rate, term)
+    remaining_balance: int = amount
+    for month in range(1, term + 1):
+        curr_interest_payment: int = get_curr_interest_payment(remaining_balance, rate)
+        curr_principal_payment: int = monthly_payment - curr_interest_payment
+        remaining_balance -= curr_principal_payment
+        if month == term:
+            yield (month, curr_interest_payment, curr_principal_payment + remaining_balance, monthly_payment + remaining_balance, 0)
+            return
+        yield (month, curr_interest_payment, curr_principal_payment, monthly_payment, remaining_balance)
+
+
 def get_loan_schedule(loan: schemas.Loan):
-    loan_schedule: List[LoanScheduleMonth] = []
-    monthly_payment: int = get_pmt(loan.amount, loan.rate, loan.term)
+    loan_schedule: List[schemas.LoanScheduleMonth] = get_loan_schedule_columns(loan.amount, loan.rate, loan.term).to_schema()
+    return loan_schedule
+
+
+def get_loan_summary(loan: schemas.Loan, month: int):
+    # The summary for `month` reports the balance at schedule index `month`
+    # and sums indexes 1..month, so only the first month + 1 months are
+    # needed; running sums stop there instead of building the full schedule.
+    if not 0 <= month < loan.term:
+        columns: LoanSchedule = get_loan_schedule_columns(loan.amount, loan.rate, loan.term)
+        return get_loan_summary_from_columns(loan, month, columns)
+    rate: int = loan.rate
+    last_index: int = loan.term - 1
+    monthly_payment: int = get_pmt(loan.amount, rate, loan.term)
     remaining_balance: int = loan.amount
-    for month in range(1, loan.term + 1):
-        curr_interest_payment: int = get_curr_interest_payment(remaining_balance, loan.rate)
+    principal_payment_sum: int = 0
+    interest_payment_sum: int = 0
+    for index in range(month + 1):
+        curr_interest_payment: int = get_curr_interest_payment(remaining_balance, rate)
         curr_principal_payment: int = monthly_payment - curr_interest_payment
         remaining_balance -= curr_principal_payment
-        if month == loan.term:
-            monthly_payment += remaining_balance
+        if index == last_index:
             curr_principal_payment += remaining_balance
             remaining_balance = 0
-        curr_schedule_month: schemas.LoanScheduleMonth = schemas.LoanScheduleMonth(
-            month=month,
-            interest_payment=curr_interest_payment,
-            principal_payment=curr_principal_payment,
-            monthly_payment=monthly_payment,
-            remaining_balance=remaining_balance
-        )
-        loan_schedule.append(curr_schedule_month)
-    return loan_schedule
+        if index > 0:
+            principal_payment_sum += curr_principal_payment
+            interest_payment_sum += curr_interest_payment
+    loan_summary: schemas.LoanSummary = schemas.LoanSummary(
+        loan_id=loan.id,
+        month=month,
+        principal_balance=remaining_balance,
+        aggregate_principal_paid=principal_payment_sum,
+        aggregate_interest_paid=interest_payment_sum
+    )
+    return loan_summary
 
 
-def get_loan_summary(loan: schemas.Loan, month: int):
-    loan_schedule: List[LoanScheduleMonth] = get_loan_schedule(loan)
-    remaining_balance = loan_schedule[month].remaining_balance
+def get_loan_summary_from_columns(loan: schemas.Loan, month: int, columns: LoanSchedule):
+    remaining_balance: int = int(columns.remaining_balance[month])
     principal_payment_sum: int = 0
     interest_payment_sum: int = 0
-    for currMonth in range(1, month + 1):
-        principal_payment_sum += loan_schedule[currMonth].principal_payment
-        interest_payment_sum += loan_schedule[currMonth].interest_payment
+    if month > 0:
+        principal_payment_sum = int(columns.aggregate_principal_paid[month] - columns.aggregate_principal_paid[0])
+        interest_payment_sum = int(columns.aggregate_interest_paid[month] - columns.aggregate_interest_paid[0])
     loan_summary: schemas.LoanSummary = schemas.LoanSummary(
         loan_id=loan.id,
         month=month,
@@ -59,3 +581,158 @@ def get_loan_summary(loan: schemas.Loan, month: int):
         aggregate_interest_paid=interest_payment_sum
     )
     return loan_summary
+
+
+def get_balance_factor(rate: int, term: int, month: int):
+    # Share of the amount still owed at schedule index `month` (after
+    # month + 1 payments) before cent rounding. It grows with both rate and
+    # term, and is 0 once the term is over.
+    payments: int = month + 1
+    if payments >= term:
+        return 0.0
+    if rate == 0:
+        return (term - payments) / term
+    growth: float = 1 + rate / 120000
+    # Negative powers only, so long terms at high rates cannot overflow.
+    return (1 - growth ** (payments - term)) / (1 - growth ** -term)
+
+
+def get_balance_amount_bounds(
+    month: int,
+    balance_min: Optional[int] = None,
+    balance_max: Optional[int] = None,
+    rate_min: Optional[int] = None,
+    rate_max: Optional[int] = None,
+    term_min: Optional[int] = None,
+    term_max: Optional[int] = None
+):
+    # Amount range that every loan whose balance at `month` lies within
+    # [balance_min, balance_max] falls in, given the rate and term bounds.
+    # The balance is amount * factor within the rounding of one cent per
+    # payment, compounded, so each bound is divided by the extreme factor
+    # after widening it by that slack. A bound that cannot be derived is
+    # None; callers still check the exact balances.
+    payments: int = month + 1
+    amount_min: Optional[int] = None
+    amount_max: Optional[int] = None
+    if rate_max is not None:
+        slack: float = payments * (1 + rate_max / 120000) ** payments + 1
+    if balance_min is not None:
+        if rate_max is None or term_max is None:
+            # An amortizing balance never exceeds the amount.
+            amount_min = balance_min
+        else:
+            high_factor: float = get_balance_factor(rate_max, term_max, month)
+            amount_min = floor((balance_min - slack) / high_factor) if high_factor > 0 else None
+    if balance_max is not None and rate_max is not None:
+        low_factor: float = get_balance_factor(rate_min or 0, max(term_min or 0, payments), month)
+        if low_factor > 0:
+            amount_max = ceil((balance_max + slack) / low_factor)
+    return amount_min, amount_max
+
+
+def get_loan_balances(loans: Sequence[LoanTerms], month: int):
+    # Exact principal balance at schedule index `month` for each loan, 0
+    # from its last month on. Only the month + 1 payments that lead up to
+    # it are stepped, for all loans at once.
+    loan_count: int = len(loans)
+    rates: np.ndarray = np.fromiter((loan.rate for loan in loans), dtype=np.int64, count=loan_count)
+    terms: np.ndarray = np.fromiter((loan.term for loan in loans), dtype=np.int64, count=loan_count)
+    monthly_payments: np.ndarray = np.fromiter(
+        (get_pmt(loan.amount, loan.rate, loan.term) for loan in loans), dtype=np.int64, count=loan_count
+    )
+    remaining_balance: np.ndarray = np.fromiter((loan.amount for loan in loans), dtype=np.int64, count=loan_count)
+    for _ in range(month + 1):
+        curr_interest_payment, remainder = np.divmod(remaining_balance * rates + 60000, 120000)
+        curr_interest_payment -= (remainder == 0) & (curr_interest_payment & 1 == 1)
+        remaining_balance -= monthly_payments - curr_interest_payment
+    remaining_balance[terms <= month + 1] = 0
+    return remaining_balance.tolist()
+
+
+class ScheduleCache:
+    # LRU of computed schedules keyed by (amount, rate, term), bounded both
+    # by entry count and by the bytes held in the column arrays.
+    def __init__(self, maxsize: int = SCHEDULE_CACHE_SIZE, max_bytes: int = SCHEDULE_CACHE_BYTES):
+        self.maxsize: int = maxsize
+        self.max_bytes: int = max_bytes
+        self.nbytes: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self._schedules: OrderedDict = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+    def get(self, amount: int, rate: int, term: int):
+        key: Tuple[int, int, int] = (amount, rate, term)
+        with self._lock:
+            columns = self._schedules.get(key)
+            if columns is not None:
+                self._schedules.move_to_end(key)
+                self.hits += 1
+                return columns
+            self.misses += 1
+        columns = get_loan_schedule_columns(amount, rate, term)
+        columns.set_read_only()
+        self.put(key, columns)
+        return columns
+
+    def put(self, key: Tuple[int, int, int], columns: LoanSchedule):
+        nbytes: int = columns.nbytes
+        with self._lock:
+            previous = self._schedules.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+            if self.maxsize <= 0 or nbytes > self.max_bytes:
+                return
+            self._schedules[key] = columns
+            self.nbytes += nbytes
+            self._evict()
+
+    def resize(self, maxsize: int, max_bytes: int):
+        with self._lock:
+            self.maxsize = maxsize
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._schedules.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            stats: Dict[str, int] = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._schedules),
+                "maxsize": self.maxsize,
+                "nbytes": self.nbytes,
+                "max_bytes": self.max_bytes
+            }
+        return stats
+
+    def _evict(self):
+        while self._schedules and (len(self._schedules) > self.maxsize or self.nbytes > self.max_bytes):
+            _, columns = self._schedules.popitem(last=False)
+            self.nbytes -= columns.nbytes
+            self.evictions += 1
+
+
+schedule_cache: ScheduleCache = ScheduleCache()
+
+
+def get_cached_loan_schedule_columns(loan: schemas.Loan):
+    return schedule_cache.get(loan.amount, loan.rate, loan.term)
+
+
+def get_cached_loan_schedule_rows(loan: schemas.Loan):
+    return get_cached_loan_schedule_columns(loan).to_rows()
+
+
+def get_cached_loan_summary(loan: schemas.Loan, month: int):
+    return get_loan_summary_from_columns(loan, month, get_cached_loan_schedule_columns(loan))
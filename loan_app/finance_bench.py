@@ -0,0 +1,133 @@
+import timeit
+import tracemalloc
+from decimal import Decimal
+from typing import List
+from . import finance, models, schemas
+
+
+TERMS: List[int] = [120, 360, 480]
+AMOUNT: int = 50000000
+RATE: int = 600
+
+
+# The float/Decimal arithmetic and the per-month Pydantic loop that finance
+# used before the integer core and the column engine, kept here as the
+# baseline to measure against.
+def reference_get_pmt(principal: int, rate: int, term: int):
+    n: int = 12
+    r: Decimal = rate / 10000
+    pmt_Decimal: Decimal = (
+        ( principal * (r/n) )
+        /( 1 - ( 1 / ( ( 1 + (r/n) )**term ) ) )
+    )
+    pmt: int = int(round(pmt_Decimal, 0))
+    return pmt
+
+
+def reference_get_curr_interest_payment(remaining_balance: int, rate: int):
+    curr_interest_payment_Decimal: Decimal = Decimal(remaining_balance * rate) / 120000
+    curr_interest_payment: int = int(round(curr_interest_payment_Decimal, 0))
+    return curr_interest_payment
+
+
+def reference_loan_schedule(loan: schemas.Loan):
+    loan_schedule: List[schemas.LoanScheduleMonth] = []
+    monthly_payment: int = reference_get_pmt(loan.amount, loan.rate, loan.term)
+    remaining_balance: int = loan.amount
+    for month in range(1, loan.term + 1):
+        curr_interest_payment: int = reference_get_curr_interest_payment(remaining_balance, loan.rate)
+        curr_principal_payment: int = monthly_payment - curr_interest_payment
+        remaining_balance -= curr_principal_payment
+        if month == loan.term:
+            monthly_payment += remaining_balance
+            curr_principal_payment += remaining_balance
+            remaining_balance = 0
+        curr_schedule_month: schemas.LoanScheduleMonth = schemas.LoanScheduleMonth(
+            month=month,
+            interest_payment=curr_interest_payment,
+            principal_payment=curr_principal_payment,
+            monthly_payment=monthly_payment,
+            remaining_balance=remaining_balance
+        )
+        loan_schedule.append(curr_schedule_month)
+    return loan_schedule
+
+
+def best_of(func, number: int, repeat: int = 5):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def measure_memory(build, loan_count: int):
+    tracemalloc.start()
+    kept = build()
+    nbytes: int = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return nbytes / loan_count
+
+
+def main():
+    print(f"{'function':>28} {'reference':>12} {'integer':>12} {'speedup':>8}")
+    for term in TERMS:
+        reference = best_of(lambda: reference_get_pmt(AMOUNT, RATE, term), number=20000)
+        integer = best_of(lambda: finance.get_pmt(AMOUNT, RATE, term), number=20000)
+        print(f"{'get_pmt term=' + str(term):>28} {reference * 1e6:>10.2f}us {integer * 1e6:>10.2f}us {reference / integer:>7.1f}x")
+    reference = best_of(lambda: reference_get_curr_interest_payment(12288888, 901), number=20000)
+    integer = best_of(lambda: finance.get_curr_interest_payment(12288888, 901), number=20000)
+    print(f"{'get_curr_interest_payment':>28} {reference * 1e6:>10.2f}us {integer * 1e6:>10.2f}us {reference / integer:>7.1f}x")
+    print(f"{'term':>6} {'reference':>12} {'columns':>12} {'rows':>12} {'speedup':>8}")
+    for term in TERMS:
+        loan = models.Loan(amount=AMOUNT, rate=RATE, term=term)
+        assert [month.model_dump() for month in reference_loan_schedule(loan)] == \
+            finance.get_loan_schedule_columns(AMOUNT, RATE, term).to_rows()
+        reference: float = best_of(lambda: reference_loan_schedule(loan), number=20)
+        columns: float = best_of(lambda: finance.get_loan_schedule_columns(AMOUNT, RATE, term), number=200)
+        rows: float = best_of(
+            lambda: finance.get_loan_schedule_columns(AMOUNT, RATE, term).to_rows(),
+            number=200
+        )
+        print(f"{term:>6} {reference * 1e6:>10.1f}us {columns * 1e6:>10.1f}us {rows * 1e6:>10.1f}us {reference / columns:>7.1f}x")
+
+    print(f"{'term':>6} {'month':>6} {'columns':>12} {'summary':>12} {'speedup':>8}")
+    for term in TERMS:
+        loan = models.Loan(id=1, amount=AMOUNT, rate=RATE, term=term)
+        for month in [1, term // 2, term - 1]:
+            columns = best_of(
+                lambda: finance.get_loan_summary_from_columns(loan, month, finance.get_loan_schedule_columns(AMOUNT, RATE, term)),
+                number=200
+            )
+            summary = best_of(lambda: finance.get_loan_summary(loan, month), number=200)
+            print(f"{term:>6} {month:>6} {columns * 1e6:>10.1f}us {summary * 1e6:>10.1f}us {columns / summary:>7.1f}x")
+
+    # Per-loan footprint of schedules kept in memory, measured on a sample;
+    # a 100k-loan portfolio is 10^5 times the figure.
+    loan_count: int = 200
+    print(f"{'term':>6} {'models':>12} {'LoanSchedule':>13} {'ratio':>8}")
+    for term in TERMS:
+        loans: List[models.Loan] = [
+            models.Loan(id=index, amount=AMOUNT + index * 1000, rate=RATE, term=term) for index in range(loan_count)
+        ]
+        model_bytes: float = measure_memory(lambda: [finance.get_loan_schedule(loan) for loan in loans], loan_count)
+        schedule_bytes: float = measure_memory(
+            lambda: [finance.get_loan_schedule_columns(loan.amount, loan.rate, loan.term) for loan in loans], loan_count
+        )
+        print(f"{term:>6} {model_bytes / 1024:>10.1f}KB {schedule_bytes / 1024:>11.1f}KB {model_bytes / schedule_bytes:>7.1f}x")
+
+    # What-if throughput: every (loan x scenario) lane is one amortization.
+    # Portfolio runs go per distinct product, so 1000 scenarios over 10^5
+    # loans costs products x 1000 lanes, split across the analytics workers.
+    scenarios: List[schemas.LoanScenario] = [
+        schemas.LoanScenario(extra_principal=index * 1000, lump_sum=index * 10000, lump_sum_month=index % 60 + 1)
+        for index in range(1000)
+    ]
+    scenario_columns = finance.get_scenario_columns(scenarios)
+    print(f"{'loans':>6} {'scenarios':>10} {'time':>12} {'lanes/s':>12}")
+    for term in TERMS:
+        loans = [finance.LoanTerms(index, AMOUNT + index * 1000, RATE, term) for index in range(100)]
+        seconds: float = best_of(lambda: finance.get_scenario_totals(loans, scenario_columns, [12, 60]), number=1, repeat=3)
+        lanes: int = len(loans) * len(scenario_columns.extra_principal)
+        print(f"{len(loans):>6} {len(scenarios):>10} {seconds * 1e3:>10.1f}ms {lanes / seconds:>12.0f}  term={term}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import pytest
+from fractions import Fraction
 from .finance import *
 from . import models
 
@@ -29,6 +30,51 @@ def test_get_pmt():
         assert calculated_pmt == test["expected_pmt"]
 
 
+def test_get_pmt__matches_exact_fraction():
+    for principal in [1, 99999, 50000000, 999999999999]:
+        for rate in [1, 375, 400, 901, 2500]:
+            for term in [1, 12, 120, 360, 480]:
+                numerator, denominator, _ = get_annuity_factor(rate, term)
+                expected_pmt = Fraction(principal * numerator, denominator)
+                calculated_pmt: int = get_pmt(principal, rate, term)
+                assert abs(calculated_pmt - expected_pmt) <= Fraction(1, 2)
+                assert calculated_pmt == round(expected_pmt)
+
+
+def test_get_pmt__zero_rate():
+    tests = [
+        {
+            "principal": 1200000,
+            "term": 12,
+            "expected_pmt": 100000
+        },
+        {
+            "principal": 5,
+            "term": 2,
+            "expected_pmt": 2
+        },
+        {
+            "principal": 7,
+            "term": 2,
+            "expected_pmt": 4
+        }
+    ]
+    for test in tests:
+        assert get_pmt(test["principal"], 0, test["term"]) == test["expected_pmt"]
+
+
+def test_div_round_half_even():
+    tests = [
+        {"numerator": 5, "denominator": 2, "expected_quotient": 2},
+        {"numerator": 7, "denominator": 2, "expected_quotient": 4},
+        {"numerator": -5, "denominator": 2, "expected_quotient": -2},
+        {"numerator": 10, "denominator": 3, "expected_quotient": 3},
+        {"numerator": 11, "denominator": 3, "expected_quotient": 4}
+    ]
+    for test in tests:
+        assert div_round_half_even(test["numerator"], test["denominator"]) == test["expected_quotient"]
+
+
 def test_get_curr_interest_payment():
     tests = [
         {
@@ -105,3 +151,266 @@ def test_get_loan_summary():
     assert loan_summary.principal_balance == 1294117
     assert loan_summary.aggregate_principal_paid == 8304967
     assert loan_summary.aggregate_interest_paid == 380013
+
+
+def test_get_loan_schedule_columns():
+    loans_details = [
+        {"amount": 10000000, "rate": 400, "term": 24},
+        {"amount": 50000000, "rate": 600, "term": 360},
+        {"amount": 60000000, "rate": 800, "term": 480},
+        {"amount": 12288888, "rate": 901, "term": 120},
+        {"amount": 3000000, "rate": 375, "term": 12}
+    ]
+    for loan_details in loans_details:
+        columns = get_loan_schedule_columns(loan_details["amount"], loan_details["rate"], loan_details["term"])
+        monthly_payment: int = get_pmt(loan_details["amount"], loan_details["rate"], loan_details["term"])
+        remaining_balance: int = loan_details["amount"]
+        for month in range(1, loan_details["term"] + 1):
+            curr_interest_payment: int = get_curr_interest_payment(remaining_balance, loan_details["rate"])
+            curr_principal_payment: int = monthly_payment - curr_interest_payment
+            remaining_balance -= curr_principal_payment
+            if month == loan_details["term"]:
+                monthly_payment += remaining_balance
+                curr_principal_payment += remaining_balance
+                remaining_balance = 0
+            assert columns.month[month - 1] == month
+            assert columns.interest_payment[month - 1] == curr_interest_payment
+            assert columns.principal_payment[month - 1] == curr_principal_payment
+            assert columns.monthly_payment[month - 1] == monthly_payment
+            assert columns.remaining_balance[month - 1] == remaining_balance
+
+
+def test_get_loan_schedule_columns__interest_rounds_half_to_even():
+    tests = [
+        {
+            "remaining_balance": 600,
+            "expected_interest_payment": 0
+        },
+        {
+            "remaining_balance": 1800,
+            "expected_interest_payment": 2
+        },
+        {
+            "remaining_balance": 3000,
+            "expected_interest_payment": 2
+        }
+    ]
+    for test in tests:
+        columns = get_loan_schedule_columns(test["remaining_balance"], 100, 1)
+        assert columns.interest_payment[0] == test["expected_interest_payment"]
+        assert get_curr_interest_payment(test["remaining_balance"], 100) == test["expected_interest_payment"]
+
+
+def test_get_portfolio_schedules():
+    loans_details = [
+        {"id": 1, "amount": 10000000, "rate": 400, "term": 24},
+        {"id": 2, "amount": 50000000, "rate": 600, "term": 360},
+        {"id": 3, "amount": 12288888, "rate": 901, "term": 120},
+        {"id": 4, "amount": 0, "rate": 400, "term": 120}
+    ]
+    db_loans = [models.Loan(**loan_details) for loan_details in loans_details]
+    portfolio_schedules = get_portfolio_schedules(db_loans)
+    assert portfolio_schedules.interest_payment.shape == (4, 360)
+    assert list(portfolio_schedules.loan_id) == [1, 2, 3, 4]
+    for index, db_loan in enumerate(db_loans):
+        expected = get_loan_schedule_columns(db_loan.amount, db_loan.rate, db_loan.term)
+        actual = portfolio_schedules.get_loan_schedule_columns(index)
+        for field in LoanScheduleRow._fields:
+            assert (getattr(actual, field) == getattr(expected, field)).all()
+        assert portfolio_schedules.mask[index].sum() == db_loan.term
+        assert not portfolio_schedules.monthly_payment[index, db_loan.term:].any()
+        assert not portfolio_schedules.remaining_balance[index, db_loan.term:].any()
+
+
+def test_loan_schedule():
+    db_loan = models.Loan(id=1, amount=10000000, rate=400, term=24)
+    loan_schedule = get_loan_schedule_columns(db_loan.amount, db_loan.rate, db_loan.term)
+    loan_schedule_months = get_loan_schedule(db_loan)
+    assert len(loan_schedule) == 24
+    assert [row._asdict() for row in loan_schedule] == [month.model_dump() for month in loan_schedule_months]
+    assert loan_schedule[0] == LoanScheduleRow(1, 33333, 400916, 434249, 9599084)
+    assert loan_schedule[-1] == tuple(loan_schedule_months[-1].model_dump().values())
+    with pytest.raises(IndexError):
+        loan_schedule[24]
+    window = loan_schedule[12:18]
+    assert len(window) == 6
+    assert list(window.month) == [13, 14, 15, 16, 17, 18]
+    assert window[0] == loan_schedule[12]
+    assert list(window) == list(loan_schedule)[12:18]
+    assert window.interest_payment.base is loan_schedule.interest_payment
+    assert window.aggregate_principal_paid[-1] == sum(month.principal_payment for month in loan_schedule_months[:18])
+    with pytest.raises(ValueError):
+        loan_schedule[::2]
+    assert loan_schedule.to_numpy().shape == (24, 5)
+    assert (loan_schedule.to_numpy()[:, 3] == loan_schedule.monthly_payment).all()
+    assert loan_schedule.to_schema() == loan_schedule_months
+    assert loan_schedule.nbytes == 5 * 8 * 24
+
+
+def test_get_portfolio_schedules__no_loans():
+    portfolio_schedules = get_portfolio_schedules([])
+    assert portfolio_schedules.interest_payment.shape == (0, 0)
+
+
+def test_get_loan_summary__matches_schedule_columns():
+    loans_details = [
+        {"id": 1, "amount": 10000000, "rate": 400, "term": 24},
+        {"id": 2, "amount": 3000000, "rate": 375, "term": 12},
+        {"id": 3, "amount": 12288888, "rate": 901, "term": 120}
+    ]
+    for loan_details in loans_details:
+        db_loan = models.Loan(**loan_details)
+        columns = get_loan_schedule_columns(loan_details["amount"], loan_details["rate"], loan_details["term"])
+        for month in range(0, loan_details["term"]):
+            assert get_loan_summary(loan=db_loan, month=month) == get_loan_summary_from_columns(loan=db_loan, month=month, columns=columns)
+
+
+def test_schedule_cache():
+    cache = ScheduleCache(maxsize=2, max_bytes=1024 * 1024)
+    first = cache.get(10000000, 400, 24)
+    assert cache.get(10000000, 400, 24) is first
+    cache.get(20000000, 450, 48)
+    cache.get(10000000, 400, 24)
+    cache.get(60000000, 800, 360)
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 3
+    assert stats["evictions"] == 1
+    assert stats["size"] == 2
+    assert cache.get(10000000, 400, 24) is first
+    assert (first.interest_payment == get_loan_schedule_columns(10000000, 400, 24).interest_payment).all()
+    assert not first.remaining_balance.flags.writeable
+
+
+def test_schedule_cache__max_bytes():
+    cache = ScheduleCache(maxsize=100, max_bytes=5 * 8 * 370)
+    cache.get(60000000, 800, 360)
+    cache.get(10000000, 400, 24)
+    assert cache.stats()["size"] == 1
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["nbytes"] == 5 * 8 * 24
+    cache.get(50000000, 600, 480)
+    assert cache.stats()["size"] == 1
+    cache.resize(maxsize=0, max_bytes=0)
+    assert cache.stats()["size"] == 0
+    assert cache.stats()["nbytes"] == 0
+
+
+def test_iter_loan_schedule():
+    for amount, rate, term in [(10000000, 400, 24), (50000000, 600, 360), (3000000, 375, 1)]:
+        columns = get_loan_schedule_columns(amount, rate, term)
+        assert list(iter_loan_schedule(amount, rate, term)) == list(zip(*(column.tolist() for column in columns.columns())))
+
+
+def test_get_portfolio_cashflows():
+    products = [
+        LoanProduct(amount=10000000, rate=400, term=24, count=3),
+        LoanProduct(amount=60000000, rate=800, term=360, count=2)
+    ]
+    cashflows = get_portfolio_cashflows(products)
+    first = get_loan_schedule_columns(10000000, 400, 24)
+    second = get_loan_schedule_columns(60000000, 800, 360)
+    assert len(cashflows.month) == 360
+    assert cashflows.interest_payment[0] == 3 * first.interest_payment[0] + 2 * second.interest_payment[0]
+    assert cashflows.total_payment[23] == 3 * first.monthly_payment[23] + 2 * second.monthly_payment[23]
+    assert cashflows.remaining_balance[24] == 2 * second.remaining_balance[24]
+    assert cashflows.principal_payment.sum() == 3 * 10000000 + 2 * 60000000
+    split = add_cashflows([get_portfolio_cashflows(products[:1]), get_portfolio_cashflows(products[1:])])
+    for field in CashflowColumns._fields:
+        assert (getattr(split, field) == getattr(cashflows, field)).all()
+
+
+def test_get_portfolio_cashflows__no_loans():
+    cashflows = add_cashflows([get_portfolio_cashflows([])])
+    assert len(cashflows.month) == 0
+
+
+def test_get_pmts():
+    principals = np.array([0, 1, 3, 5, 10000000, 50000000, 123456789], dtype=np.int64)
+    rates = np.array([0, 0, 0, 0, 400, 600, 725], dtype=np.int64)
+    terms = np.array([2, 2, 2, 2, 24, 360, 180], dtype=np.int64)
+    expected = [get_pmt(int(principal), int(rate), int(term)) for principal, rate, term in zip(principals, rates, terms)]
+    assert get_pmts(principals, rates, terms).tolist() == expected
+    assert get_pmts(principals[:0], rates[:0], terms[:0]).tolist() == []
+
+
+def test_get_scenario_totals():
+    loan = LoanTerms(id=1, amount=10000000, rate=400, term=24)
+    schedule = get_loan_schedule_columns(loan.amount, loan.rate, loan.term)
+    scenarios = [
+        schemas.LoanScenario(extra_principal=100000, extra_principal_start_month=3),
+        schemas.LoanScenario(lump_sum=10000000, lump_sum_month=1),
+        schemas.LoanScenario(payoff_month=12),
+        schemas.LoanScenario(rate_reset_month=13, reset_rate=800)
+    ]
+    totals = get_scenario_totals([loan], get_scenario_columns(scenarios), [0, 12, 24]).get_loan_totals(0)
+    assert totals.total_interest[0] == schedule.interest_payment.sum()
+    assert totals.total_principal.tolist() == [loan.amount] * 5
+    assert totals.payoff_month.tolist()[:4] == [24, 20, 1, 12]
+    assert totals.balances[0].tolist() == [loan.amount, schedule.remaining_balance[11], 0]
+    assert totals.total_interest[1] < totals.total_interest[0]
+    assert totals.total_interest[2] == schedule.interest_payment[0]
+    assert totals.total_interest[3] == schedule.interest_payment[:12].sum()
+    assert totals.balances[3].tolist() == [loan.amount, 0, 0]
+    # After the reset the rest of the loan amortizes like a new 12 month
+    # loan for the balance left at month 12.
+    rest = get_loan_schedule_columns(int(schedule.remaining_balance[11]), 800, 12)
+    assert totals.total_interest[4] == schedule.interest_payment[:12].sum() + rest.interest_payment.sum()
+    assert totals.balances[4].tolist() == [loan.amount, schedule.remaining_balance[11], 0]
+
+
+def test_get_portfolio_scenario_totals():
+    products = [
+        LoanProduct(amount=10000000, rate=400, term=24, count=3),
+        LoanProduct(amount=60000000, rate=800, term=360, count=2)
+    ]
+    scenario_columns = get_scenario_columns([schemas.LoanScenario(extra_principal=500000)])
+    loan_totals = get_scenario_totals(products, scenario_columns, [12])
+    totals = get_portfolio_scenario_totals(products, scenario_columns, [12])
+    assert totals.total_interest.tolist() == (3 * loan_totals.total_interest[0] + 2 * loan_totals.total_interest[1]).tolist()
+    assert totals.payoff_month.tolist() == [360, loan_totals.payoff_month[1, 1]]
+    assert totals.balances[:, 0].tolist() == (3 * loan_totals.balances[0, :, 0] + 2 * loan_totals.balances[1, :, 0]).tolist()
+    split = add_scenario_totals([
+        get_portfolio_scenario_totals(products[:1], scenario_columns, [12]),
+        get_portfolio_scenario_totals(products[1:], scenario_columns, [12])
+    ])
+    for field in ScenarioTotals._fields:
+        assert (getattr(split, field) == getattr(totals, field)).all()
+    no_loans = get_portfolio_scenario_totals([], scenario_columns, [12])
+    assert no_loans.total_interest.tolist() == [0, 0]
+    assert no_loans.balances.shape == (2, 1)
+
+
+def test_get_loan_balances():
+    loans = [LoanTerms(1, 10000000, 400, 24), LoanTerms(2, 60000000, 800, 360), LoanTerms(3, 3000000, 0, 12)]
+    for month in [0, 11, 23, 200]:
+        expected = [
+            int(get_loan_schedule_columns(loan.amount, loan.rate, loan.term).remaining_balance[month]) if month < loan.term else 0
+            for loan in loans
+        ]
+        assert get_loan_balances(loans, month) == expected
+    assert get_loan_balances([], 5) == []
+
+
+def test_get_balance_amount_bounds():
+    loans = [
+        LoanTerms(index, amount, rate, term)
+        for index, (amount, rate, term) in enumerate(
+            (amount, rate, term) for amount in range(1000000, 100000001, 9900000)
+            for rate in [300, 600, 900] for term in [24, 120, 360]
+        )
+    ]
+    for month in [0, 23, 100]:
+        balances = get_loan_balances(loans, month)
+        for balance_min, balance_max in [(5000000, 50000000), (None, 20000000), (30000000, None)]:
+            amount_min, amount_max = get_balance_amount_bounds(month, balance_min, balance_max, 300, 900, 24, 360)
+            for loan, balance in zip(loans, balances):
+                if loan.term <= month or balance_min is not None and balance < balance_min:
+                    continue
+                if balance_max is not None and balance > balance_max:
+                    continue
+                assert amount_min is None or loan.amount >= amount_min
+                assert amount_max is None or loan.amount <= amount_max
+    assert get_balance_amount_bounds(10, balance_min=100, balance_max=200) == (100, None)
+    assert get_balance_factor(400, 24, 23) == 0.0
+    assert get_balance_factor(0, 24, 11) == 0.5
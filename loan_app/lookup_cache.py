@@ -0,0 +1,179 @@
+import math
+import os
+from abc import ABC, abstractmethod
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+import orjson
+
+
+LOOKUP_CACHE_SIZE: int = int(os.environ.get("LOAN_APP_LOOKUP_CACHE_SIZE", "65536"))
+LOOKUP_CACHE_TTL: float = float(os.environ.get("LOAN_APP_LOOKUP_CACHE_TTL", "300"))
+# "Not found" answers are cached too, but briefly: with the local backend a
+# row created by another worker stays invisible here until this expires.
+LOOKUP_CACHE_NEGATIVE_TTL: float = float(os.environ.get("LOAN_APP_LOOKUP_CACHE_NEGATIVE_TTL", "5"))
+CACHE_MISS = object()
+
+
+class CacheBackend(ABC):
+    # Values are JSON-compatible (dicts, lists, ints, strings, None) so any
+    # backend can hold them; None is a cached "not found", CACHE_MISS means
+    # the key is absent. A backend missing any method fails when it is
+    # constructed, not in the middle of a request.
+    @abstractmethod
+    def get(self, key: str):
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: Any, ttl: float):
+        ...
+
+    @abstractmethod
+    def delete(self, *keys: str):
+        ...
+
+    @abstractmethod
+    def clear(self):
+        ...
+
+
+class LocalCacheBackend(CacheBackend):
+    # Per-process LRU with a per-entry expiry.
+    def __init__(self, maxsize: int = LOOKUP_CACHE_SIZE, clock: Callable[[], float] = time.monotonic):
+        self.maxsize: int = maxsize
+        self._clock = clock
+        self._entries: OrderedDict = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry: Optional[Tuple[float, Any]] = self._entries.get(key)
+            if entry is None:
+                return CACHE_MISS
+            expires_at, value = entry
+            if expires_at <= self._clock():
+                del self._entries[key]
+                return CACHE_MISS
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl: float):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self._clock() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SharedCacheBackend(CacheBackend):
+    # Stores JSON in a cache shared by all workers through a client with the
+    # get / set(ex=) / delete subset of the redis-py API, e.g.
+    # SharedCacheBackend(redis.Redis(...)). Writes invalidate for every
+    # worker at once, not just the one that made them.
+    def __init__(self, client, prefix: str = "loan_app:"):
+        self.client = client
+        self.prefix: str = prefix
+
+    def get(self, key: str):
+        raw: Optional[bytes] = self.client.get(self.prefix + key)
+        if raw is None:
+            return CACHE_MISS
+        return orjson.loads(raw)
+
+    def set(self, key: str, value: Any, ttl: float):
+        self.client.set(self.prefix + key, orjson.dumps(value), ex=max(math.ceil(ttl), 1))
+
+    def delete(self, *keys: str):
+        if keys:
+            self.client.delete(*(self.prefix + key for key in keys))
+
+    def clear(self):
+        keys = self.client.keys(self.prefix + "*")
+        if keys:
+            self.client.delete(*keys)
+
+
+class LocalSharedClient:
+    # In-process stand-in for the shared cache server, for tests and single
+    # process development.
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self._values: Dict[str, Tuple[float, bytes]] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def get(self, name: str):
+        with self._lock:
+            entry: Optional[Tuple[float, bytes]] = self._values.get(name)
+            if entry is None or entry[0] <= self._clock():
+                self._values.pop(name, None)
+                return None
+            return entry[1]
+
+    def set(self, name: str, value: bytes, ex: int):
+        with self._lock:
+            self._values[name] = (self._clock() + ex, value)
+
+    def delete(self, *names: str):
+        with self._lock:
+            return sum(self._values.pop(name, None) is not None for name in names)
+
+    def keys(self, pattern: str):
+        prefix: str = pattern.rstrip("*")
+        with self._lock:
+            return [name for name in self._values if name.startswith(prefix)]
+
+
+class LookupCache:
+    # Read-through front for the crud lookups: keys are "<namespace>:<id>"
+    # and hits/misses are counted per namespace.
+    def __init__(self, backend: CacheBackend, ttl: float = LOOKUP_CACHE_TTL, negative_ttl: float = LOOKUP_CACHE_NEGATIVE_TTL):
+        self.backend: CacheBackend = backend
+        self.ttl: float = ttl
+        self.negative_ttl: float = negative_ttl
+        self.hits: Dict[str, int] = defaultdict(int)
+        self.misses: Dict[str, int] = defaultdict(int)
+        self._lock: threading.Lock = threading.Lock()
+
+    def get(self, namespace: str, key: int):
+        value = self.backend.get(f"{namespace}:{key}")
+        with self._lock:
+            if value is CACHE_MISS:
+                self.misses[namespace] += 1
+            else:
+                self.hits[namespace] += 1
+        return value
+
+    def set(self, namespace: str, key: int, value: Any):
+        self.backend.set(f"{namespace}:{key}", value, self.ttl if value is not None else self.negative_ttl)
+
+    def invalidate(self, namespace: str, keys: Iterable[int]):
+        self.backend.delete(*(f"{namespace}:{key}" for key in keys))
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self.hits.clear()
+            self.misses.clear()
+
+    def stats(self):
+        stats: Dict[str, Dict[str, float]] = {}
+        with self._lock:
+            counts = [(namespace, self.hits[namespace], self.misses[namespace]) for namespace in set(self.hits) | set(self.misses)]
+        for namespace, hits, misses in sorted(counts):
+            stats[namespace] = {"hits": hits, "misses": misses, "hit_ratio": hits / (hits + misses) if hits + misses else 0.0}
+        return stats
+
+
+lookup_cache: LookupCache = LookupCache(LocalCacheBackend())
@@ -1,99 +1,343 @@
-from typing import List
-from fastapi import Depends, FastAPI, HTTPException
+import asyncio
+from contextlib import asynccontextmanager
+from itertools import chain
+from typing import Dict, List, Optional
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from sqlalchemy.orm import Session
-from . import crud, models, schemas, finance
-from .database import SessionLocal, engine
+from . import analytics, bulk, crud, database, schemas, finance, metrics, migrations, pagination, quotes, responses, streaming, warmup
 
 
-models.Base.metadata.create_all(bind=engine)
-app = FastAPI()
+router = APIRouter()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Nothing touches the database before this runs: engines are created on
+    # first use and the schema is brought up to date here.
+    if migrations.MIGRATE_ON_STARTUP:
+        if database.async_engine is not None:
+            async with database.async_engine.begin() as connection:
+                await connection.run_sync(migrations.upgrade)
+        else:
+            await run_in_threadpool(migrations.upgrade_engine, database.engine)
+    warmup_task: Optional[asyncio.Task] = None
+    if warmup.WARMUP == "1":
+        await warmup.warm_up(app)
+    elif warmup.WARMUP == "background":
+        warmup_task = asyncio.create_task(warmup.warm_up(app))
+    analytics.analytics_pool.start()
+    yield
+    if warmup_task is not None:
+        await warmup_task
+    analytics.analytics_pool.shutdown()
+    if database.async_engine is not None:
+        await database.async_engine.dispose()
+
+
+def create_app():
+    # Each call builds an independent app around the routes below; run with
+    # `uvicorn --factory loan_app.main:create_app`.
+    app = FastAPI(lifespan=lifespan)
+    if responses.GZIP_ENABLED:
+        app.add_middleware(GZipMiddleware, minimum_size=responses.GZIP_MINIMUM_SIZE)
+    app.add_middleware(metrics.MetricsMiddleware)
+    app.include_router(router)
+    return app
+
+
+def __getattr__(name: str):
+    # `loan_app.main:app` and `from .main import app` still work; the app is
+    # built on first access and reused after.
+    if name == "app":
+        globals()["app"] = create_app()
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # Dependency
-def get_db():
-    db = SessionLocal()
+async def get_db():
+    if database.AsyncSessionLocal is not None:
+        async with database.AsyncSessionLocal() as db:
+            yield db
+        return
+    db = database.SessionLocal()
     try:
         yield db
     finally:
         db.close()
 
 
-@app.get("/")
-def root():
+@router.get("/")
+async def root():
     return {"message": "loan_app"}
 
 
-@app.post("/users/", response_model=schemas.User)
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email)
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def read_metrics():
+    if not metrics.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return metrics.registry.render()
+
+
+@router.get("/quotes", response_model=List[schemas.Quote])
+async def read_quotes(
+    request: Request,
+    amount: List[str] = Query(),
+    rate: List[str] = Query(),
+    term: List[str] = Query(),
+    month: Optional[int] = None,
+    layout: responses.Layout = "records"
+):
+    # No database: amount, rate and term take values, comma separated lists
+    # or start:stop:step ranges, and every combination is quoted.
+    # Ranges are counted, not expanded, until the request is known to fit.
+    amount_ranges = quotes.get_query_ranges("amount", amount, minimum=0)
+    rate_ranges = quotes.get_query_ranges("rate", rate, minimum=0)
+    term_ranges = quotes.get_query_ranges("term", term, minimum=1, maximum=quotes.MAX_QUOTE_TERM)
+    if month is not None and month < 0:
+        raise HTTPException(status_code=400, detail="Invalid month")
+    quote_count = quotes.get_value_count(amount_ranges) * quotes.get_value_count(rate_ranges) * quotes.get_value_count(term_ranges)
+    if quote_count > quotes.MAX_QUOTES:
+        raise HTTPException(status_code=400, detail=f"At most {quotes.MAX_QUOTES} quotes per request")
+    etag = responses.get_etag("quotes", request.url.query)
+    if responses.is_not_modified(request, etag):
+        return responses.get_not_modified_response(etag)
+    rows = await run_in_threadpool(
+        metrics.timed_finance(quotes.get_quote_rows), amounts=list(chain.from_iterable(amount_ranges)),
+        rates=list(chain.from_iterable(rate_ranges)), terms=list(chain.from_iterable(term_ranges)), month=month
+    )
+    return responses.ORJSONResponse(
+        responses.get_layout_content(quotes.QUOTE_FIELDS, rows, layout), headers=responses.get_cache_headers(etag)
+    )
+
+
+@router.post("/users/", response_model=schemas.User)
+async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+    db_user = await crud.run(db, crud.get_user_by_email, email=user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    return crud.create_user(db=db, user=user)
+    return await crud.run(db, crud.create_user, user=user)
 
 
-@app.get("/users/", response_model=List[schemas.User])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    users = crud.get_users(db, skip=skip, limit=limit)
-    return users
+@router.post("/users:bulk", response_model=schemas.BulkResult)
+async def create_users_bulk(request: Request, db: Session = Depends(get_db)):
+    items = bulk.parse_bulk_body(await request.body(), request.headers.get("content-type", ""))
+    return await crud.run(db, bulk.create_bulk, items=items, schema=schemas.UserCreate, create_chunk=crud.create_users_bulk)
 
 
-@app.get("/users/{user_id}", response_model=schemas.User)
-def read_user(user_id: int, db: Session = Depends(get_db)):
-    db_user = crud.get_user(db, user_id=user_id)
+@router.get("/users/", response_model=List[schemas.User])
+async def read_users(skip: int = 0, limit: int = 100, cursor: Optional[str] = None, layout: responses.Layout = "records", db: Session = Depends(get_db)):
+    after_id = pagination.decode_cursor(cursor)
+    users = await crud.run(db, crud.get_users, skip=skip, limit=limit, after_id=after_id)
+    response = responses.ORJSONResponse(responses.get_users_content(users, layout))
+    pagination.set_next_cursor(response, users, limit)
+    return response
+
+
+@router.get("/users/{user_id}", response_model=schemas.User)
+async def read_user(user_id: int, db: Session = Depends(get_db)):
+    db_user = await crud.run(db, crud.get_cached_user, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
 
 
-@app.post("/users/loans/", response_model=schemas.Loan)
-def create_loan_for_user(loan: schemas.LoanCreate, db: Session = Depends(get_db)):
+@router.post("/users/loans/", response_model=schemas.Loan)
+async def create_loan_for_user(loan: schemas.LoanCreate, db: Session = Depends(get_db)):
     if len(loan.user_ids) < 1:
         raise HTTPException(status_code=400, detail="No user_ids provided")
-    for user_id in loan.user_ids:
-        db_user = crud.get_user(db, user_id=user_id)
-        if db_user is None:
-            raise HTTPException(status_code=404, detail="User not found")
-    return crud.create_user_loan(db=db, loan_create=loan)
+    if await crud.run(db, crud.get_missing_user_ids, user_ids=loan.user_ids):
+        raise HTTPException(status_code=404, detail="User not found")
+    return await crud.run(db, crud.create_user_loan, loan_create=loan)
+
+
+@router.post("/loans:bulk", response_model=schemas.BulkResult)
+async def create_loans_bulk(request: Request, db: Session = Depends(get_db)):
+    items = bulk.parse_bulk_body(await request.body(), request.headers.get("content-type", ""))
+    return await crud.run(db, bulk.create_bulk, items=items, schema=schemas.LoanCreate, create_chunk=crud.create_user_loans_bulk)
+
+
+@router.get("/loans/", response_model=List[schemas.Loan])
+async def read_loans(skip: int = 0, limit: int = 100, cursor: Optional[str] = None, layout: responses.Layout = "records", db: Session = Depends(get_db)):
+    after_id = pagination.decode_cursor(cursor)
+    loans = await crud.run(db, crud.get_loans, skip=skip, limit=limit, after_id=after_id)
+    response = responses.ORJSONResponse(responses.get_loans_content(loans, layout))
+    pagination.set_next_cursor(response, loans, limit)
+    return response
+
+
+@router.get("/loans/search", response_model=List[schemas.Loan])
+async def search_loans(search: schemas.LoanSearch = Depends(), limit: int = 100, cursor: Optional[str] = None, layout: responses.Layout = "records", db: Session = Depends(get_db)):
+    if search.month < 0:
+        raise HTTPException(status_code=400, detail="Invalid month")
+    after_id = pagination.decode_cursor(cursor)
+    loans = await crud.run(db, crud.search_loans, search=search, limit=limit, after_id=after_id)
+    response = responses.ORJSONResponse(responses.get_loans_content(loans, layout))
+    pagination.set_next_cursor(response, loans, limit)
+    return response
+
 
+@router.get("/loans/schedules:export", response_class=StreamingResponse)
+async def export_loan_schedules(request: Request, db: Session = Depends(get_db)):
+    media_type = streaming.get_stream_media_type(request.headers.get("accept", "")) or streaming.NDJSON_MEDIA_TYPE
+    return StreamingResponse(iter_loan_schedules_export(db, media_type), media_type=media_type)
 
-@app.get("/loans/", response_model=List[schemas.Loan])
-def read_loans(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    loans = crud.get_loans(db, skip=skip, limit=limit)
-    return loans
 
+async def iter_loan_schedules_export(db: Session, media_type: str):
+    yield streaming.get_header(media_type, with_loan_id=True)
+    async for chunk in analytics.analytics_pool.imap(
+        analytics.format_loan_schedules_export, iter_loan_terms_pages(db, media_type)
+    ):
+        yield chunk
 
-@app.get("/loans/{loan_id}", response_model=schemas.Loan)
-def read_loan(loan_id: int, db: Session = Depends(get_db)):
-    db_loan = crud.get_loan(db, loan_id = loan_id)
+
+async def iter_loan_terms_pages(db: Session, media_type: str):
+    after_id = None
+    while True:
+        db_loans = await crud.run(db, crud.get_loan_terms, limit=analytics.ANALYTICS_CHUNK_SIZE, after_id=after_id)
+        if not db_loans:
+            return
+        yield (media_type, db_loans)
+        after_id = db_loans[-1].id
+
+
+@router.get("/loans/{loan_id}", response_model=schemas.Loan)
+async def read_loan(loan_id: int, db: Session = Depends(get_db)):
+    db_loan = await crud.run(db, crud.get_cached_loan, loan_id=loan_id)
     if db_loan is None:
         raise HTTPException(status_code=404, detail="Loan not found")
     return db_loan
 
 
-@app.get("/loans/{loan_id}/schedule", response_model=List[schemas.LoanScheduleMonth])
-def read_loan_schedule(loan_id: int, db: Session = Depends(get_db)):
-    db_loan = crud.get_loan(db, loan_id = loan_id)
+@router.get("/loans/{loan_id}/schedule", response_model=List[schemas.LoanScheduleMonth])
+async def read_loan_schedule(request: Request, loan_id: int, layout: responses.Layout = "records", db: Session = Depends(get_db)):
+    media_type = streaming.get_stream_media_type(request.headers.get("accept", ""))
+    db_loan = await crud.run(db, crud.get_cached_loan_terms, loan_id=loan_id)
     if db_loan is None:
         raise HTTPException(status_code=404, detail="Loan not found")
-    loan_schedule = finance.get_loan_schedule(loan=db_loan)
-    return loan_schedule
+    # Revalidation is answered from the loan terms alone, before any
+    # schedule is read or computed.
+    # JSON, NDJSON and CSV share the URL, so caches must key on Accept.
+    etag = responses.get_etag("schedule", db_loan.amount, db_loan.rate, db_loan.term, media_type or layout)
+    if responses.is_not_modified(request, etag):
+        return responses.get_not_modified_response(etag, vary=["Accept"])
+    headers = responses.get_cache_headers(etag, vary=["Accept"])
+    if media_type is None and crud.PERSIST_SCHEDULES:
+        db_loan_schedule = await crud.run(db, crud.get_loan_schedule, loan_id=loan_id)
+        if db_loan_schedule:
+            rows = [tuple(db_loan_schedule_month) for db_loan_schedule_month in db_loan_schedule]
+            return responses.ORJSONResponse(responses.get_layout_content(streaming.SCHEDULE_FIELDS, rows, layout), headers=headers)
+    if media_type is not None:
+        loan_schedule = finance.iter_loan_schedule(db_loan.amount, db_loan.rate, db_loan.term)
+        return StreamingResponse(streaming.iter_schedule_lines(media_type, loan_schedule), media_type=media_type, headers=headers)
+    columns = await run_in_threadpool(metrics.timed_finance(finance.get_cached_loan_schedule_columns), loan=db_loan)
+    return responses.ORJSONResponse(responses.get_loan_schedule_content(columns, layout), headers=headers)
+
+
+@router.post("/loans/schedules:batch", response_class=StreamingResponse)
+async def read_loan_schedules_batch(loan_schedule_batch: schemas.LoanScheduleBatchCreate, db: Session = Depends(get_db)):
+    if len(loan_schedule_batch.loan_ids) < 1:
+        raise HTTPException(status_code=400, detail="No loan_ids provided")
+    loan_ids: List[int] = loan_schedule_batch.loan_ids
+    db_loans: Dict[int, finance.LoanTerms] = {
+        db_loan.id: db_loan for db_loan in await crud.run(db, crud.get_loan_terms_by_ids, loan_ids=loan_ids)
+    }
+    chunks = analytics.iter_chunks([(loan_id, db_loans.get(loan_id)) for loan_id in loan_ids])
+    return StreamingResponse(
+        analytics.analytics_pool.imap(analytics.format_loan_schedules_batch, chunks),
+        media_type=streaming.NDJSON_MEDIA_TYPE
+    )
 
 
-@app.get("/users/{user_id}/loans", response_model=List[schemas.Loan])
-def read_loans_for_user(user_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    db_user = crud.get_user(db, user_id=user_id)
+@router.get("/users/{user_id}/loans", response_model=List[schemas.Loan])
+async def read_loans_for_user(user_id: int, skip: int = 0, limit: int = 100, cursor: Optional[str] = None, layout: responses.Layout = "records", db: Session = Depends(get_db)):
+    after_id = pagination.decode_cursor(cursor)
+    db_user = await crud.run(db, crud.get_cached_user, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    db_loans = crud.get_user_loans(db, user_id = user_id)
-    return db_loans
+    db_loans = await crud.run(db, crud.get_user_loans, user_id=user_id, skip=skip, limit=limit, after_id=after_id)
+    response = responses.ORJSONResponse(responses.get_loans_content(db_loans, layout))
+    pagination.set_next_cursor(response, db_loans, limit)
+    return response
 
 
-@app.get("/loans/{loan_id}/summary", response_model=schemas.LoanSummary)
-def read_loan_summary(loan_id: int, month: int, db: Session = Depends(get_db)):
-    db_loan = crud.get_loan(db, loan_id = loan_id)
+@router.get("/loans/{loan_id}/summary", response_model=schemas.LoanSummary)
+async def read_loan_summary(request: Request, response: Response, loan_id: int, month: int, db: Session = Depends(get_db)):
+    db_loan = await crud.run(db, crud.get_cached_loan_terms, loan_id=loan_id)
     if db_loan is None:
         raise HTTPException(status_code=404, detail="Loan not found")
     if month > db_loan.term:
         raise HTTPException(status_code=400, detail="Month higher than loan term")
-    loan_summary = finance.get_loan_summary(loan=db_loan, month=month)
+    etag = responses.get_etag("summary", db_loan.id, db_loan.amount, db_loan.rate, db_loan.term, month)
+    if responses.is_not_modified(request, etag):
+        return responses.get_not_modified_response(etag)
+    response.headers.update(responses.get_cache_headers(etag))
+    if crud.PERSIST_SCHEDULES and month >= 0:
+        loan_summary = await crud.run(db, crud.get_loan_summary, loan_id=loan_id, month=month)
+        if loan_summary is not None:
+            return loan_summary
+    loan_summary = await run_in_threadpool(metrics.timed_finance(finance.get_cached_loan_summary), loan=db_loan, month=month)
     return loan_summary
+
+
+def check_scenario_request(scenario_request: schemas.ScenarioRequest):
+    if len(scenario_request.scenarios) > finance.MAX_SCENARIOS:
+        raise HTTPException(status_code=400, detail=f"At most {finance.MAX_SCENARIOS} scenarios per request")
+    for scenario in scenario_request.scenarios:
+        if scenario.rate_reset_month is not None and scenario.reset_rate is None:
+            raise HTTPException(status_code=400, detail="reset_rate is required with rate_reset_month")
+        if min(scenario.extra_principal, scenario.lump_sum, scenario.reset_rate or 0) < 0:
+            raise HTTPException(status_code=400, detail="Scenario amounts and rates must not be negative")
+        months = [scenario.extra_principal_start_month, scenario.lump_sum_month, scenario.rate_reset_month, scenario.payoff_month]
+        if any(month is not None and month < 1 for month in months):
+            raise HTTPException(status_code=400, detail="Scenario months start at 1")
+    if len(scenario_request.balance_months) > finance.MAX_BALANCE_MONTHS:
+        raise HTTPException(status_code=400, detail=f"At most {finance.MAX_BALANCE_MONTHS} balance_months per request")
+    if any(month < 0 for month in scenario_request.balance_months):
+        raise HTTPException(status_code=400, detail="balance_months must not be negative")
+
+
+@router.post("/loans/{loan_id}/scenarios", response_model=schemas.ScenarioResults, response_model_exclude_none=True)
+async def read_loan_scenarios(loan_id: int, scenario_request: schemas.ScenarioRequest, db: Session = Depends(get_db)):
+    check_scenario_request(scenario_request)
+    db_loan = await crud.run(db, crud.get_cached_loan_terms, loan_id=loan_id)
+    if db_loan is None:
+        raise HTTPException(status_code=404, detail="Loan not found")
+    scenario_columns = finance.get_scenario_columns(scenario_request.scenarios)
+    totals = await run_in_threadpool(
+        metrics.timed_finance(finance.get_scenario_totals),
+        loans=[db_loan], scenario_columns=scenario_columns, balance_months=scenario_request.balance_months
+    )
+    return finance.get_scenario_results(totals.get_loan_totals(0), scenario_request.scenarios, scenario_request.outputs)
+
+
+@router.post("/portfolio/scenarios", response_model=schemas.ScenarioResults, response_model_exclude_none=True)
+async def read_portfolio_scenarios(scenario_request: schemas.ScenarioRequest, db: Session = Depends(get_db)):
+    check_scenario_request(scenario_request)
+    products = await crud.run(db, crud.get_loan_products)
+    scenario_columns = finance.get_scenario_columns(scenario_request.scenarios)
+    with metrics.time_finance():
+        totals = await analytics.get_portfolio_scenarios(products, scenario_columns, scenario_request.balance_months)
+        return finance.get_scenario_results(totals, scenario_request.scenarios, scenario_request.outputs)
+
+
+@router.get("/portfolio/cashflows", response_model=List[schemas.CashflowMonth])
+async def read_portfolio_cashflows(db: Session = Depends(get_db)):
+    products = await crud.run(db, crud.get_loan_products)
+    with metrics.time_finance():
+        cashflows = await analytics.get_portfolio_cashflows(products)
+        return finance.get_cashflow_rows(cashflows)
+
+
+@router.get("/users/{user_id}/cashflows", response_model=List[schemas.CashflowMonth])
+async def read_user_cashflows(user_id: int, db: Session = Depends(get_db)):
+    db_user = await crud.run(db, crud.get_cached_user, user_id=user_id)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    products = await crud.run(db, crud.get_loan_products, user_id=user_id)
+    with metrics.time_finance():
+        cashflows = await analytics.get_portfolio_cashflows(products)
+        return finance.get_cashflow_rows(cashflows)
@@ -1,15 +1,25 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.pool import StaticPool
 from sqlalchemy.orm import sessionmaker
-from .main import app, get_db
-from .database import Base
-from . import models
+from .main import app, create_app, get_db
+from .database import Base, count_queries
+from . import analytics, crud, database, finance, metrics, migrations, models, quotes, responses, schemas, warmup
+from .lookup_cache import CACHE_MISS, CacheBackend, LocalCacheBackend, LocalSharedClient, SharedCacheBackend, lookup_cache
+from .rebuild_schedules import rebuild_schedules
 
 
 client = TestClient(app)
 DATABASE_URL = "sqlite:///:memory:"
+# e.g. postgresql+psycopg2://postgres@localhost/loan_app_test, an empty
+# database the migration tests may create and drop tables in.
+POSTGRESQL_URL = os.environ.get("LOAN_APP_TEST_POSTGRESQL_URL")
 engine = create_engine(
     DATABASE_URL, connect_args={"check_same_thread": False}, poolclass=StaticPool
 )
@@ -33,6 +43,53 @@ def test_read_root():
     assert response.json()["message"] == "loan_app"
 
 
+def test_read_quotes():
+    with count_queries(engine) as queries:
+        response = client.get("/quotes?amount=10000000&rate=400:500:50&term=24,360&month=20")
+    assert queries.count == 0
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == "public, max-age=86400"
+    quote_rows = response.json()
+    assert [(quote["rate"], quote["term"]) for quote in quote_rows] == [
+        (400, 24), (400, 360), (450, 24), (450, 360), (500, 24), (500, 360)
+    ]
+    for quote in quote_rows:
+        monthly_payment = finance.get_pmt(10000000, quote["rate"], quote["term"])
+        assert quote["monthly_payment"] == monthly_payment
+        assert quote["total_payment"] == monthly_payment * quote["term"]
+        assert quote["total_interest"] == monthly_payment * quote["term"] - 10000000
+        loan = models.Loan(id=1, amount=10000000, rate=quote["rate"], term=quote["term"])
+        summary = finance.get_loan_summary(loan, 20).model_dump()
+        del summary["loan_id"]
+        assert quote["summary"] == summary
+    response = client.get("/quotes?amount=100,200&rate=0&term=12&month=12&layout=columns")
+    assert response.json()["monthly_payment"] == [8, 17]
+    assert response.json()["summary"] == [None, None]
+    for query, detail in [
+        ("amount=100&rate=400&term=0", "Invalid term"),
+        ("amount=100&rate=400&term=360,601", "Invalid term"),
+        ("amount=100&rate=4:1:0&term=12", "Invalid rate"),
+        ("amount=x&rate=400&term=12", "Invalid amount"),
+        ("amount=100&rate=400&term=12&month=-1", "Invalid month"),
+        ("amount=1:10000:1&rate=0:10:1&term=12", "At most 10000 quotes per request"),
+        ("amount=1:1000000000000:1&rate=400&term=12", "At most 10000 quotes per request"),
+        ("amount=5:1:1&rate=400&term=12", "Invalid amount")
+    ]:
+        response = client.get(f"/quotes?{query}")
+        assert response.status_code == 400
+        assert response.json()["detail"] == detail
+
+
+def test_precompute_annuity_factors(monkeypatch):
+    monkeypatch.setattr(quotes, "annuity_factors", {})
+    assert quotes.parse_values(["12:36:12,60", "360"]) == [12, 24, 36, 60, 360]
+    assert quotes.get_value_count(quotes.parse_ranges(["1:1000000000000:1,7"])) == 1000000000001
+    assert quotes.precompute_annuity_factors(rates=[0, 400], terms=[12, 360]) == 4
+    assert quotes.annuity_factors[(400, 360)] == finance.get_annuity_factor(400, 360)
+    assert quotes.get_annuity_factor(401, 360) == finance.get_annuity_factor(401, 360)
+    assert (401, 360) not in quotes.annuity_factors
+
+
 def test_create_user():
     email: string = "rmiller@email.com"
     response = client.post("/users/", json={"email": email})
@@ -53,6 +110,36 @@ def test_create_user__missing_email():
         response = client.post("/users/", json={"text": email})
 
 
+def test_create_users_bulk():
+    users = [{"email": "a@email.com"}, {"email": "jsmith@email.com"}, {"email": "a@email.com"}, {"text": "b"}, {"email": "b@email.com"}]
+    response = client.post("/users:bulk", json=users)
+    assert response.status_code == 200
+    assert response.json()["created"] == 2
+    assert response.json()["failed"] == 3
+    items = response.json()["items"]
+    assert [item["index"] for item in items] == [0, 1, 2, 3, 4]
+    assert items[0]["id"] == 3
+    assert items[1]["detail"] == "Email already registered"
+    assert items[2]["detail"] == "Email already registered"
+    assert items[3]["detail"] == "email: Field required"
+    assert items[4]["id"] == 4
+    assert client.get("/users/4").json()["email"] == "b@email.com"
+
+
+def test_create_users_bulk__ndjson():
+    body = '{"email": "a@email.com"}\nnot json\n\n{"email": "b@email.com"}\n'
+    response = client.post("/users:bulk", content=body, headers={"content-type": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.json()["created"] == 2
+    assert response.json()["items"][1] == {"index": 1, "id": None, "detail": "Invalid JSON"}
+
+
+def test_create_users_bulk__not_an_array():
+    response = client.post("/users:bulk", json={"email": "a@email.com"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Expected a JSON array"
+
+
 def test_read_users():
     response = client.get("/users/")
     assert response.status_code == 200
@@ -63,6 +150,27 @@ def test_read_users():
     assert response.json()[1]["id"] == 2 
 
 
+def test_read_users__cursor():
+    response = client.get("/users/?limit=1")
+    assert response.status_code == 200
+    assert [user["id"] for user in response.json()] == [1]
+    cursor = response.headers["X-Next-Cursor"]
+    response = client.get(f"/users/?limit=1&cursor={cursor}")
+    assert response.status_code == 200
+    assert [user["id"] for user in response.json()] == [2]
+    cursor = response.headers["X-Next-Cursor"]
+    response = client.get(f"/users/?limit=1&cursor={cursor}")
+    assert response.status_code == 200
+    assert response.json() == []
+    assert "X-Next-Cursor" not in response.headers
+
+
+def test_read_users__invalid_cursor():
+    response = client.get("/users/?cursor=not-a-cursor")
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor"
+
+
 def test_read_user():
     response = client.get("/users/2")
     assert response.status_code == 200
@@ -103,12 +211,95 @@ def test_create_loan_for_user__missing_amount():
     assert response.json()["detail"][0]["loc"] == ["body", "amount"]
 
 
+def test_create_loans_bulk():
+    loans = [
+        {"user_ids": [1, 2, 2], "amount": 3000000, "rate": 375, "term": 12},
+        {"user_ids": [1, 3], "amount": 3000000, "rate": 375, "term": 12},
+        {"user_ids": [], "amount": 3000000, "rate": 375, "term": 12},
+        {"user_ids": [2], "amount": 5000000, "rate": 500, "term": 60}
+    ]
+    with count_queries(engine) as queries:
+        response = client.post("/loans:bulk", json=loans)
+    assert response.status_code == 200
+    assert queries.count == 4
+    assert response.json()["created"] == 2
+    items = response.json()["items"]
+    assert items[0]["id"] == 4
+    assert items[1]["detail"] == "User not found"
+    assert items[2]["detail"] == "No user_ids provided"
+    assert items[3]["id"] == 5
+    response = client.get("/loans/4")
+    assert [user["id"] for user in response.json()["users"]] == [1, 2]
+    assert [loan["id"] for loan in client.get("/users/2/loans").json()] == [2, 3, 4, 5]
+
+
 def test_read_loans():
     response = client.get("/loans/")
     assert response.status_code == 200
     assert len(response.json()) == 3
 
 
+def test_search_loans(monkeypatch):
+    def search(query):
+        response = client.get(f"/loans/search?{query}")
+        assert response.status_code == 200
+        return [loan["id"] for loan in response.json()]
+
+    assert search("") == [1, 2, 3]
+    assert search("term_min=48&rate_min=450") == [2, 3]
+    assert search("term_min=360&term_max=360") == [3]
+    assert search("amount_max=20000000&user_id=2") == [2]
+    assert search("rate_max=300") == []
+    response = client.get("/loans/search?limit=2")
+    assert [loan["id"] for loan in response.json()] == [1, 2]
+    assert search(f"limit=2&cursor={response.headers['X-Next-Cursor']}") == [3]
+    assert client.get("/loans/search?layout=columns&term_min=360").json()["users"] == [[
+        {"email": "jsmith@email.com", "id": 1}, {"email": "jdoe@email.com", "id": 2}
+    ]]
+    balances = {
+        loan_id: client.get(f"/loans/{loan_id}/summary?month=20").json()["principal_balance"] for loan_id in [1, 2, 3]
+    }
+    for persist in [False, True]:
+        monkeypatch.setattr(crud, "PERSIST_SCHEDULES", persist)
+        if persist:
+            session = TestingSessionLocal()
+            rebuild_schedules(session)
+            session.close()
+        assert search(f"month=20&balance_min={balances[2]}") == [2, 3]
+        assert search(f"month=20&balance_min={balances[2] + 1}") == [3]
+        assert search(f"month=20&balance_max={balances[1]}&rate_max=800") == [1]
+        assert search(f"month=20&balance_min=0&term_max=48") == [1, 2]
+        assert search(f"month=23&balance_max=0") == [1]
+        assert search(f"month=24&balance_max=0") == []
+    response = client.get("/loans/search?month=-1&balance_min=0")
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid month"
+
+
+def test_search_loans__query_plan():
+    db = TestingSessionLocal()
+    with count_queries(engine) as queries:
+        crud.search_loans(db, schemas.LoanSearch(term_min=360, term_max=360, rate_min=600, rate_max=900))
+    db.close()
+    with engine.connect() as connection:
+        parameters = (360, 600, 900, 100, 0)
+        plan = " ".join(row[3] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + queries.statements[0], parameters))
+        assert "ix_loans_term_rate_amount (term=? AND rate>? AND rate<?)" in plan
+
+
+def test_read_loans__cursor():
+    loan_ids = []
+    cursor = None
+    while True:
+        response = client.get("/loans/", params={"limit": 2, "cursor": cursor})
+        assert response.status_code == 200
+        loan_ids += [loan["id"] for loan in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert loan_ids == [1, 2, 3]
+
+
 def test_read_loan():
     response = client.get("/loans/3")
     assert response.status_code == 200
@@ -145,24 +336,355 @@ def test_read_loan_schedule():
     assert response.json()[23]["remaining_balance"] == 0
 
 
+def test_read_loan_schedule__ndjson():
+    response = client.get("/loans/1/schedule", headers={"accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines == client.get("/loans/1/schedule").json()
+
+
+def test_read_loan_schedule__csv():
+    response = client.get("/loans/1/schedule", headers={"accept": "text/csv"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    lines = response.text.splitlines()
+    assert len(lines) == 25
+    assert lines[0] == "month,interest_payment,principal_payment,monthly_payment,remaining_balance"
+    assert lines[1] == "1,33333,400916,434249,9599084"
+    assert lines[24] == "24,1443,432814,434257,0"
+
+
+def test_export_loan_schedules():
+    response = client.get("/loans/schedules:export", headers={"accept": "text/csv"})
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert lines[0] == "loan_id,month,interest_payment,principal_payment,monthly_payment,remaining_balance"
+    assert len(lines) == 1 + 24 + 48 + 360
+    assert lines[1] == "1,1,33333,400916,434249,9599084"
+    assert lines[25].startswith("2,1,")
+    assert lines[-1].startswith("3,360,")
+    response = client.get("/loans/schedules:export")
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == 24 + 48 + 360
+    assert lines[0] == {"loan_id": 1, **client.get("/loans/1/schedule").json()[0]}
+
+
+def test_response_layouts():
+    db = TestingSessionLocal()
+    expected = {
+        "/users/": [schemas.User.model_validate(db_user).model_dump() for db_user in crud.get_users(db)],
+        "/loans/": [schemas.Loan.model_validate(db_loan).model_dump() for db_loan in crud.get_loans(db)],
+        "/users/2/loans": [schemas.Loan.model_validate(db_loan).model_dump() for db_loan in crud.get_user_loans(db, user_id=2)],
+        "/loans/3/schedule": [loan_schedule_month.model_dump() for loan_schedule_month in finance.get_loan_schedule(crud.get_loan(db, loan_id=3))]
+    }
+    db.close()
+    for url, records in expected.items():
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.json() == records
+        fields = list(records[0])
+        response = client.get(url, params={"layout": "columns"})
+        assert response.json() == {field: [record[field] for record in records] for field in fields}
+        response = client.get(url, params={"layout": "tuples"})
+        assert response.json() == {"fields": fields, "rows": [[record[field] for field in fields] for record in records]}
+    response = client.get("/users/?layout=columns&limit=1")
+    assert response.json() == {"email": ["jsmith@email.com"], "id": [1]}
+    assert "X-Next-Cursor" in response.headers
+    assert client.get("/users/5/loans?layout=columns").status_code == 404
+    assert client.get("/loans/?layout=xml").status_code == 422
+
+
+def test_conditional_requests(monkeypatch):
+    response = client.get("/loans/1/schedule")
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "public, max-age=86400"
+    assert response.headers["vary"] == "Accept"
+    assert client.get("/loans/1/schedule?layout=columns").headers["etag"] != etag
+    response = client.get("/loans/1/schedule", headers={"Accept": "text/csv"})
+    assert response.headers["etag"] != etag
+    assert response.headers["vary"] == "Accept"
+    assert client.get("/loans/1/schedule", headers={"If-None-Match": '"stale"'}).status_code == 200
+
+    def fail(*args, **kwargs):
+        raise AssertionError("schedule computed for a conditional request")
+
+    monkeypatch.setattr(finance, "get_cached_loan_schedule_columns", fail)
+    monkeypatch.setattr(finance, "get_cached_loan_summary", fail)
+    with count_queries(engine) as queries:
+        for if_none_match in [etag, f'"stale", W/{etag}', "*"]:
+            response = client.get("/loans/1/schedule", headers={"If-None-Match": if_none_match})
+            assert response.status_code == 304
+            assert response.headers["etag"] == etag
+            assert response.headers["vary"] == "Accept"
+            assert response.content == b""
+    assert queries.count == 0
+    monkeypatch.undo()
+
+    summary_etag = client.get("/loans/1/summary?month=20").headers["etag"]
+    assert client.get("/loans/1/summary?month=21").headers["etag"] != summary_etag
+    response = client.get("/loans/1/summary?month=20", headers={"If-None-Match": summary_etag})
+    assert response.status_code == 304
+    monkeypatch.setattr(finance, "FINANCE_VERSION", "test")
+    assert client.get("/loans/1/schedule", headers={"If-None-Match": etag}).status_code == 200
+    assert client.get("/loans/1/summary?month=20", headers={"If-None-Match": summary_etag}).status_code == 200
+
+    # Compressed and identity bodies share the tag, so it must be weak.
+    monkeypatch.setattr(responses, "GZIP_ENABLED", True)
+    response = client.get("/loans/1/schedule")
+    weak_etag = response.headers["etag"]
+    assert weak_etag.startswith('W/"')
+    for if_none_match in [weak_etag, weak_etag.removeprefix("W/")]:
+        response = client.get("/loans/1/schedule", headers={"If-None-Match": if_none_match})
+        assert response.status_code == 304
+        assert response.headers["etag"] == weak_etag
+        assert response.headers["vary"] == "Accept, Accept-Encoding"
+
+
 def test_read_loan_schedule__loan_does_not_exist():
     response = client.get("/loans/4/schedule")
     assert response.status_code == 404
     assert response.json()["detail"] == "Loan not found"
 
 
+def test_read_loan_schedules_batch():
+    response = client.post("/loans/schedules:batch", json={"loan_ids": [3, 4, 1]})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == 3
+    assert lines[0]["loan_id"] == 3
+    assert len(lines[0]["schedule"]) == 360
+    assert lines[0]["schedule"][359]["remaining_balance"] == 0
+    assert lines[1]["loan_id"] == 4
+    assert lines[1]["detail"] == "Loan not found"
+    assert lines[2]["loan_id"] == 1
+    assert lines[2]["schedule"] == client.get("/loans/1/schedule").json()
+
+
+def test_read_loan_schedules_batch__process_pool(monkeypatch):
+    analytics_pool = analytics.AnalyticsPool(workers=2)
+    analytics_pool.start()
+    monkeypatch.setattr(analytics, "analytics_pool", analytics_pool)
+    monkeypatch.setattr(analytics, "ANALYTICS_CHUNK_SIZE", 1)
+    try:
+        response = client.post("/loans/schedules:batch", json={"loan_ids": [1, 2, 4, 3]})
+        export_response = client.get("/loans/schedules:export", headers={"accept": "text/csv"})
+    finally:
+        analytics_pool.shutdown()
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["loan_id"] for line in lines] == [1, 2, 4, 3]
+    assert lines[0]["schedule"] == client.get("/loans/1/schedule").json()
+    assert lines[2]["detail"] == "Loan not found"
+    assert export_response.text == client.get("/loans/schedules:export", headers={"accept": "text/csv"}).text
+
+
+def test_read_loan_schedules_batch__no_loan_ids():
+    response = client.post("/loans/schedules:batch", json={"loan_ids": []})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "No loan_ids provided"
+
+
+def test_persisted_schedules(monkeypatch):
+    monkeypatch.setattr(crud, "PERSIST_SCHEDULES", True)
+    expected_schedule = client.get("/loans/1/schedule").json()
+    expected_summary = client.get("/loans/1/summary?month=20").json()
+    session = TestingSessionLocal()
+    assert rebuild_schedules(session, chunk_size=2) == 3
+    assert session.query(models.LoanScheduleMonth).count() == 24 + 48 + 360
+    session.close()
+    with count_queries(engine) as queries:
+        assert client.get("/loans/1/schedule").json() == expected_schedule
+        assert client.get("/loans/1/summary?month=20").json() == expected_summary
+    assert queries.count == 2
+    db_loan = models.Loan(id=1, amount=10000000, rate=400, term=24)
+    for month in range(0, 24):
+        summary = client.get(f"/loans/1/summary?month={month}").json()
+        assert summary == finance.get_loan_summary(loan=db_loan, month=month).model_dump()
+    response = client.post("/users/loans/", json={"user_ids": [1], "amount": 3000000, "rate": 375, "term": 12})
+    loan_id = response.json()["id"]
+    response = client.post("/loans:bulk", json=[{"user_ids": [2], "amount": 5000000, "rate": 500, "term": 60}])
+    bulk_loan_id = response.json()["items"][0]["id"]
+    session = TestingSessionLocal()
+    assert session.query(models.LoanScheduleMonth).filter(models.LoanScheduleMonth.loan_id == loan_id).count() == 12
+    assert session.query(models.LoanScheduleMonth).filter(models.LoanScheduleMonth.loan_id == bulk_loan_id).count() == 60
+    session.close()
+    persisted_schedule = client.get(f"/loans/{bulk_loan_id}/schedule").json()
+    monkeypatch.setattr(crud, "PERSIST_SCHEDULES", False)
+    assert persisted_schedule == client.get(f"/loans/{bulk_loan_id}/schedule").json()
+
+
 def test_read_loans_for_user():
     response = client.get("/users/2/loans")
     assert response.status_code == 200
     assert len(response.json()) == 2
 
 
+def test_read_loans_for_user__pagination():
+    response = client.get("/users/2/loans?skip=1&limit=1")
+    assert response.status_code == 200
+    assert [loan["id"] for loan in response.json()] == [3]
+    response = client.get("/users/2/loans?limit=1")
+    assert [loan["id"] for loan in response.json()] == [2]
+    cursor = response.headers["X-Next-Cursor"]
+    response = client.get(f"/users/2/loans?limit=1&cursor={cursor}")
+    assert [loan["id"] for loan in response.json()] == [3]
+
+
 def test_read_loans_for_user__user_does_not_exist():
     response = client.get("/users/3/loans")
     assert response.status_code == 404
     assert response.json()["detail"] == "User not found"
 
 
+def test_read_loans_for_user__query_plan():
+    db = TestingSessionLocal()
+    with count_queries(engine) as queries:
+        crud.get_user_loans(db, user_id=1, after_id=1)
+    db.close()
+    with engine.connect() as connection:
+        for statement in queries.statements[:2]:
+            parameters = (1,) * statement.count("?")
+            plan = " ".join(row[3] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters))
+            assert "SCAN user_loan" not in plan and "TEMP B-TREE" not in plan
+
+
+def check_migrate_user_loan(legacy_engine, legacy_columns: str):
+    with legacy_engine.begin() as connection:
+        Base.metadata.create_all(bind=connection, tables=[models.User.__table__, models.Loan.__table__])
+        connection.execute(text("INSERT INTO users (email) VALUES ('a@email.com'), ('b@email.com')"))
+        connection.execute(text("INSERT INTO loans (amount, rate, term) VALUES (100, 400, 12), (200, 400, 12), (300, 400, 12)"))
+        connection.execute(text(f"CREATE TABLE user_loan ({legacy_columns})"))
+        connection.execute(text("INSERT INTO user_loan (user_id, loan_id) VALUES (1, 1), (1, 1), (2, 1), (NULL, 2), (2, 3)"))
+    with legacy_engine.begin() as connection:
+        migrations.upgrade(connection)
+        assert migrations.migrate_user_loan(connection) is False
+    with legacy_engine.connect() as connection:
+        rows = connection.execute(text("SELECT user_id, loan_id FROM user_loan ORDER BY user_id, loan_id")).all()
+        legacy_inspector = inspect(connection)
+        primary_key = legacy_inspector.get_pk_constraint("user_loan")
+        index_names = [index["name"] for index in legacy_inspector.get_indexes("user_loan")]
+        assert "user_loan_rows" not in legacy_inspector.get_table_names()
+    assert rows == [(1, 1), (2, 1), (2, 3)]
+    assert primary_key["constrained_columns"] == ["user_id", "loan_id"]
+    assert index_names == ["ix_user_loan_loan_id_user_id"]
+    return primary_key["name"]
+
+
+def test_migrate_user_loan():
+    legacy_engine = create_engine("sqlite://", poolclass=StaticPool)
+    check_migrate_user_loan(legacy_engine, "id INTEGER PRIMARY KEY, user_id INTEGER, loan_id INTEGER")
+
+
+@pytest.mark.skipif(POSTGRESQL_URL is None, reason="LOAN_APP_TEST_POSTGRESQL_URL is not set")
+def test_migrate_user_loan__postgresql():
+    # Runs against an empty PostgreSQL database: the rebuilt table has to
+    # end up with the same constraint names as a freshly created one.
+    legacy_engine = create_engine(POSTGRESQL_URL)
+    drop_tables = text("DROP TABLE IF EXISTS schema_migrations, loan_schedule, user_loan, user_loan_rows, loans, users CASCADE")
+    try:
+        with legacy_engine.begin() as connection:
+            connection.execute(drop_tables)
+        primary_key_name = check_migrate_user_loan(
+            legacy_engine,
+            "id SERIAL PRIMARY KEY, user_id INTEGER REFERENCES users (id), loan_id INTEGER REFERENCES loans (id)"
+        )
+        assert primary_key_name == "user_loan_pkey"
+        with legacy_engine.connect() as connection:
+            foreign_keys = {foreign_key["name"] for foreign_key in inspect(connection).get_foreign_keys("user_loan")}
+        assert foreign_keys == {"user_loan_user_id_fkey", "user_loan_loan_id_fkey"}
+    finally:
+        with legacy_engine.begin() as connection:
+            connection.execute(drop_tables)
+        legacy_engine.dispose()
+
+
+def test_migrations():
+    fresh_engine = create_engine("sqlite://", poolclass=StaticPool)
+    assert migrations.upgrade_engine(fresh_engine) == [1, 2, 3]
+    assert migrations.upgrade_engine(fresh_engine) == []
+    with fresh_engine.connect() as connection:
+        assert migrations.get_applied_versions(connection) == {1, 2, 3}
+        assert set(Base.metadata.tables) <= set(inspect(connection).get_table_names())
+    with fresh_engine.begin() as connection:
+        connection.execute(text("DROP INDEX ix_loans_term_rate_amount"))
+        connection.execute(text("DELETE FROM schema_migrations WHERE version = 3"))
+    assert migrations.upgrade_engine(fresh_engine) == [3]
+    with fresh_engine.connect() as connection:
+        index_names = {index["name"] for index in inspect(connection).get_indexes("loans")}
+        assert {"ix_loans_term_rate_amount", "ix_loans_rate_amount", "ix_loans_amount"} <= index_names
+
+
+def test_migrations__empty_database(monkeypatch):
+    # Steps written against an existing schema, e.g. an ADD COLUMN that
+    # create_all already covered, never run on an empty database.
+    def add_column(connection):
+        connection.execute(text("ALTER TABLE loans ADD COLUMN note VARCHAR"))
+
+    monkeypatch.setattr(migrations, "MIGRATIONS", migrations.MIGRATIONS + [migrations.Migration(4, "add_note", add_column)])
+    fresh_engine = create_engine("sqlite://", poolclass=StaticPool)
+    assert migrations.upgrade_engine(fresh_engine) == [1, 2, 3, 4]
+    with fresh_engine.connect() as connection:
+        assert "note" not in {column["name"] for column in inspect(connection).get_columns("loans")}
+    existing_engine = create_engine("sqlite://", poolclass=StaticPool)
+    Base.metadata.create_all(bind=existing_engine)
+    assert migrations.upgrade_engine(existing_engine) == [1, 2, 3, 4]
+    with existing_engine.connect() as connection:
+        assert "note" in {column["name"] for column in inspect(connection).get_columns("loans")}
+
+
+def test_migrate_on_startup():
+    with TestClient(app):
+        pass
+    with database.engine.connect() as connection:
+        assert max(migrations.get_applied_versions(connection)) == migrations.HEAD
+
+
+def test_create_app():
+    other_app = create_app()
+    assert other_app is not app
+    assert other_app.openapi()["paths"].keys() == app.openapi()["paths"].keys()
+    # Neither importing the app nor building it may touch the database, so
+    # an unreachable server (or a missing driver) only matters at startup.
+    env = dict(os.environ, LOAN_APP_DATABASE_URL="postgresql://loan_app@unreachable.invalid/loan_app")
+    result = subprocess.run(
+        [sys.executable, "-c", "import sys; from loan_app import database, main; main.app; sys.exit(len(database._engines))"],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env=env, capture_output=True
+    )
+    assert result.returncode == 0, result.stderr
+
+
+def test_warm_up(monkeypatch):
+    monkeypatch.setattr(quotes, "annuity_factors", {})
+    monkeypatch.setattr(quotes, "QUOTE_RATES", "400:500:50")
+    monkeypatch.setattr(quotes, "QUOTE_TERMS", "360")
+    monkeypatch.setattr(warmup, "WARMUP_SCHEDULES", 1)
+    monkeypatch.setattr(database, "SessionLocal", TestingSessionLocal)
+    client.post("/users/loans/", json={"user_ids": [2], "amount": 20000000, "rate": 450, "term": 48})
+    db = TestingSessionLocal()
+    assert crud.get_loan_products(db, limit=2) == [(20000000, 450, 48, 2), (10000000, 400, 24, 1)]
+    db.close()
+    finance.schedule_cache.clear()
+    assert asyncio.run(warmup.warm_up(create_app())) == {"annuity_factors": 3, "schedules": 1}
+    assert sorted(quotes.annuity_factors) == [(400, 360), (450, 360), (500, 360)]
+    assert finance.schedule_cache.stats()["size"] == 1
+    finance.schedule_cache.get(20000000, 450, 48)
+    assert finance.schedule_cache.stats()["hits"] == 1
+    assert asyncio.run(warmup.send_request(create_app(), "/")) == 200
+
+
+def test_sqlite_file_pragmas(tmp_path):
+    url = f"sqlite:///{tmp_path / 'loan_app.db'}"
+    file_engine = database.create_database_engine(url)
+    with file_engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+    file_engine.dispose()
+    assert not database.is_sqlite_file("sqlite:///:memory:")
+
+
 def test_read_loan_summary():
     response = client.get("/loans/1/summary?month=20")
     assert response.status_code == 200
@@ -185,7 +707,289 @@ def test_read_loan_summary__month_higher_than_loan_term():
     assert response.json()["detail"] == "Month higher than loan term"
 
 
+def test_query_counts():
+    tests = [
+        {
+            "method": "get",
+            "url": "/loans/",
+            "expected_query_count": 2
+        },
+        {
+            "method": "get",
+            "url": "/loans/3",
+            "expected_query_count": 2
+        },
+        {
+            "method": "get",
+            "url": "/users/2/loans",
+            "expected_query_count": 3
+        },
+        {
+            "method": "get",
+            "url": "/loans/3/schedule",
+            "expected_query_count": 1
+        },
+        {
+            "method": "get",
+            "url": "/loans/3/summary?month=20",
+            "expected_query_count": 1
+        },
+        {
+            "method": "post",
+            "url": "/users/loans/",
+            "json": {"user_ids": [1, 2, 1], "amount": 3000000, "rate": 375, "term": 12},
+            "expected_query_count": 5
+        },
+        {
+            "method": "post",
+            "url": "/users/loans/",
+            "json": {"user_ids": [1, 2, 3], "amount": 3000000, "rate": 375, "term": 12},
+            "expected_query_count": 1
+        }
+    ]
+    for test in tests:
+        # Cold lookups: the shape of each endpoint's queries, not the cache.
+        lookup_cache.clear()
+        with count_queries(engine) as queries:
+            response = client.request(test["method"], test["url"], json=test.get("json"))
+        assert response.status_code in (200, 404)
+        assert queries.count == test["expected_query_count"]
+
+
+def test_lookup_cache__warm_reads():
+    for url, cold_query_count in [("/loans/3/schedule", 1), ("/loans/3/summary?month=20", 0), ("/loans/3", 2), ("/users/1", 1)]:
+        with count_queries(engine) as queries:
+            assert client.get(url).status_code == 200
+        assert queries.count == cold_query_count
+        with count_queries(engine) as queries:
+            assert client.get(url).status_code == 200
+        assert queries.count == 0
+    with count_queries(engine) as queries:
+        response = client.post("/users/loans/", json={"user_ids": [1], "amount": 3000000, "rate": 375, "term": 12})
+    assert response.status_code == 200
+    assert queries.count == 4
+    stats = lookup_cache.stats()
+    assert stats["loan_terms"] == {"hits": 3, "misses": 1, "hit_ratio": 0.75}
+    assert stats["user"] == {"hits": 2, "misses": 1, "hit_ratio": 2 / 3}
+
+
+def test_lookup_cache__invalidated_on_create():
+    assert client.get("/users/3").status_code == 404
+    assert client.get("/users/3/loans").status_code == 404
+    assert client.get("/loans/4").status_code == 404
+    assert client.get("/loans/4/schedule").status_code == 404
+    assert client.post("/users/loans/", json={"user_ids": [3], "amount": 3000000, "rate": 375, "term": 12}).status_code == 404
+    assert client.post("/users/", json={"email": "rmiller@email.com"}).json()["id"] == 3
+    assert client.get("/users/3").json()["email"] == "rmiller@email.com"
+    assert client.post("/users/loans/", json={"user_ids": [3], "amount": 3000000, "rate": 375, "term": 12}).json()["id"] == 4
+    assert client.get("/loans/4").json()["users"] == [{"email": "rmiller@email.com", "id": 3}]
+    assert len(client.get("/loans/4/schedule").json()) == 12
+    assert client.get("/loans/5").status_code == 404
+    response = client.post("/loans:bulk", json=[{"user_ids": [3], "amount": 3000000, "rate": 375, "term": 12}])
+    assert response.json()["items"][0]["id"] == 5
+    assert client.get("/loans/5").status_code == 200
+
+
+def test_lookup_cache__backends(monkeypatch):
+    now = [0.0]
+    local_backend = LocalCacheBackend(maxsize=2, clock=lambda: now[0])
+    shared_backend = SharedCacheBackend(LocalSharedClient(clock=lambda: now[0]))
+    for backend in [local_backend, shared_backend]:
+        now[0] = 0.0
+        backend.set("user:1", {"email": "jsmith@email.com", "id": 1}, ttl=10)
+        backend.set("user:9", None, ttl=2)
+        assert backend.get("user:1") == {"email": "jsmith@email.com", "id": 1}
+        assert backend.get("user:9") is None
+        assert backend.get("user:2") is CACHE_MISS
+        now[0] = 5.0
+        assert backend.get("user:9") is CACHE_MISS
+        backend.delete("user:1")
+        assert backend.get("user:1") is CACHE_MISS
+        backend.set("user:1", None, ttl=10)
+        backend.clear()
+        assert backend.get("user:1") is CACHE_MISS
+    for key in ["loan:1", "loan:2", "loan:3"]:
+        local_backend.set(key, [1], ttl=10)
+    assert local_backend.get("loan:1") is CACHE_MISS
+    monkeypatch.setattr(lookup_cache, "backend", SharedCacheBackend(LocalSharedClient()))
+    assert client.get("/loans/3").json()["users"] == [{"email": "jsmith@email.com", "id": 1}, {"email": "jdoe@email.com", "id": 2}]
+    assert client.get("/loans/3").json()["users"][1]["email"] == "jdoe@email.com"
+    assert client.get("/loans/3/summary?month=20").status_code == 200
+    assert client.get("/loans/3/summary?month=20").json()["principal_balance"] > 0
+    assert lookup_cache.stats()["loan"]["hits"] == 1
+
+
+def test_lookup_cache__incomplete_backend():
+    class GetOnlyBackend(CacheBackend):
+        def get(self, key: str):
+            return CACHE_MISS
+
+    with pytest.raises(TypeError):
+        GetOnlyBackend()
+
+
+def test_read_portfolio_cashflows():
+    client.post("/users/loans/", json={"user_ids": [2], "amount": 10000000, "rate": 400, "term": 24})
+    response = client.get("/portfolio/cashflows")
+    assert response.status_code == 200
+    cashflows = response.json()
+    assert len(cashflows) == 360
+    schedules = [client.get(f"/loans/{loan_id}/schedule").json() for loan_id in [1, 2, 3, 4]]
+    for month in [0, 23, 24, 47, 359]:
+        expected = [schedule[month] for schedule in schedules if month < len(schedule)]
+        assert cashflows[month]["month"] == month + 1
+        assert cashflows[month]["interest_payment"] == sum(row["interest_payment"] for row in expected)
+        assert cashflows[month]["principal_payment"] == sum(row["principal_payment"] for row in expected)
+        assert cashflows[month]["total_payment"] == sum(row["monthly_payment"] for row in expected)
+        assert cashflows[month]["remaining_balance"] == sum(row["remaining_balance"] for row in expected)
+
+
+def test_read_user_cashflows():
+    response = client.get("/users/1/cashflows")
+    assert response.status_code == 200
+    cashflows = response.json()
+    assert len(cashflows) == 360
+    assert sum(row["principal_payment"] for row in cashflows) == 10000000 + 60000000
+    response = client.get("/users/3/cashflows")
+    assert response.status_code == 404
+    assert response.json()["detail"] == "User not found"
+
+
+def test_read_loan_scenarios():
+    schedule = client.get("/loans/1/schedule").json()
+    response = client.post("/loans/1/scenarios", json={
+        "scenarios": [
+            {"name": "extra", "extra_principal": 100000},
+            {"name": "reset", "rate_reset_month": 12, "reset_rate": 900},
+            {"payoff_month": 6}
+        ],
+        "balance_months": [1, 6],
+        "outputs": ["total_interest", "interest_delta", "payoff_month", "balances"]
+    })
+    assert response.status_code == 200
+    results = response.json()
+    assert results["base"] == {
+        "total_interest": sum(row["interest_payment"] for row in schedule),
+        "interest_delta": 0,
+        "payoff_month": len(schedule),
+        "balances": [schedule[0]["remaining_balance"], schedule[5]["remaining_balance"]]
+    }
+    extra, reset, payoff = results["scenarios"]
+    assert extra["name"] == "extra"
+    assert set(extra) == {"name", "total_interest", "interest_delta", "payoff_month", "balances"}
+    assert extra["interest_delta"] < 0
+    assert extra["payoff_month"] < len(schedule)
+    assert reset["interest_delta"] > 0
+    assert reset["balances"] == results["base"]["balances"]
+    assert payoff["payoff_month"] == 6
+    assert payoff["total_interest"] == sum(row["interest_payment"] for row in schedule[:6])
+    assert payoff["balances"] == [schedule[0]["remaining_balance"], 0]
+
+
+def test_read_loan_scenarios__invalid(monkeypatch):
+    response = client.post("/loans/1/scenarios", json={"scenarios": [{"rate_reset_month": 12}]})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "reset_rate is required with rate_reset_month"
+    response = client.post("/loans/1/scenarios", json={"scenarios": [{"lump_sum": 100, "lump_sum_month": 0}]})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Scenario months start at 1"
+    monkeypatch.setattr(finance, "MAX_BALANCE_MONTHS", 2)
+    response = client.post("/loans/1/scenarios", json={"scenarios": [], "balance_months": [1, 2, 3]})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "At most 2 balance_months per request"
+    response = client.post("/loans/10/scenarios", json={"scenarios": []})
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Loan not found"
+
+
+def test_read_portfolio_scenarios(monkeypatch):
+    request = {
+        "scenarios": [{"extra_principal": 50000}, {"lump_sum": 1000000, "lump_sum_month": 3}],
+        "balance_months": [12],
+        "outputs": ["total_interest", "total_principal", "payoff_month", "payoff_month_delta", "balances"]
+    }
+    response = client.post("/portfolio/scenarios", json=request)
+    assert response.status_code == 200
+    portfolio = response.json()
+    loan_ids = [loan["id"] for loan in client.get("/loans/").json()]
+    loans = [client.post(f"/loans/{loan_id}/scenarios", json=request).json() for loan_id in loan_ids]
+    for key in ["base", 0, 1]:
+        results = [loan["base"] if key == "base" else loan["scenarios"][key] for loan in loans]
+        expected = portfolio["base"] if key == "base" else portfolio["scenarios"][key]
+        assert expected["total_interest"] == sum(result["total_interest"] for result in results)
+        assert expected["total_principal"] == sum(result["total_principal"] for result in results)
+        assert expected["payoff_month"] == max(result["payoff_month"] for result in results)
+        assert expected["balances"] == [sum(result["balances"][0] for result in results)]
+    assert portfolio["base"]["payoff_month"] == 360
+    assert portfolio["scenarios"][0]["payoff_month_delta"] < 0
+    # 3 lanes per product (base + 2 scenarios), each also holding one
+    # balance month: a budget of 12 lanes fits 2 products per chunk.
+    chunk_sizes = []
+    iter_chunks = analytics.iter_chunks
+
+    def record_chunk_size(items, chunk_size=None):
+        chunk_sizes.append(chunk_size)
+        return iter_chunks(items, chunk_size)
+
+    monkeypatch.setattr(analytics, "SCENARIO_CHUNK_LANES", 12)
+    monkeypatch.setattr(analytics, "iter_chunks", record_chunk_size)
+    assert client.post("/portfolio/scenarios", json=request).json() == portfolio
+    assert chunk_sizes == [2]
+
+
+def test_metrics(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_ENABLED", True)
+    metrics.registry.clear()
+    response = client.get("/loans/3/summary?month=12")
+    assert response.status_code == 200
+    server_timing = response.headers["server-timing"]
+    assert 'desc="1 queries"' in server_timing
+    assert "finance;dur=" in server_timing and "total;dur=" in server_timing
+    client.get("/loans/2/summary?month=24")
+    client.get("/loans/99")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert 'loan_app_request_duration_seconds_count{method="GET",route="/loans/{loan_id}/summary",status="200"} 2' in lines
+    assert 'loan_app_request_duration_seconds_bucket{method="GET",route="/loans/{loan_id}",status="404",le="+Inf"} 1' in lines
+    assert 'loan_app_sql_statements_total{method="GET",route="/loans/{loan_id}/summary"} 2' in lines
+    finance_seconds = [line for line in lines if line.startswith('loan_app_finance_seconds_total{method="GET",route="/loans/{loan_id}/summary"}')]
+    assert float(finance_seconds[0].split()[-1]) > 0
+    assert any(line.startswith("loan_app_schedule_cache_hits_total ") for line in lines)
+    assert 'loan_app_lookup_cache_hit_ratio{namespace="loan_terms"} 0.0' in lines
+
+
+def test_metrics__disabled(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_ENABLED", False)
+    response = client.get("/loans/3/summary?month=12")
+    assert "server-timing" not in response.headers
+    assert client.get("/metrics").status_code == 404
+
+
+def test_crud_run__async_session():
+    pytest.importorskip("aiosqlite")
+    pytest.importorskip("greenlet")
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+    async def create_and_read_loan():
+        async_engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with async_engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        async with async_sessionmaker(bind=async_engine, expire_on_commit=False)() as db:
+            db_user = await crud.run(db, crud.create_user, user=schemas.UserCreate(email="async@email.com"))
+            loan_create = schemas.LoanCreate(user_ids=[db_user.id], amount=3000000, rate=375, term=12)
+            await crud.run(db, crud.create_user_loan, loan_create=loan_create)
+            db_loans = await crud.run(db, crud.get_user_loans, user_id=db_user.id)
+        await async_engine.dispose()
+        return db_loans
+
+    db_loans = asyncio.run(create_and_read_loan())
+    assert len(db_loans) == 1
+    assert db_loans[0].users[0].email == "async@email.com"
+
+
 def setup() -> None:
+    lookup_cache.clear()
     Base.metadata.create_all(bind=engine)
     session = TestingSessionLocal()
     emails = ["jsmith@email.com", "jdoe@email.com"]
@@ -0,0 +1,212 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Dict, List, Optional, Tuple
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from . import finance
+from .lookup_cache import lookup_cache
+
+
+METRICS_ENABLED: bool = os.environ.get("LOAN_APP_METRICS") == "1"
+LATENCY_BUCKETS: Tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SERVER_TIMING_HEADER: bytes = b"server-timing"
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets: Tuple[float, ...] = buckets
+        # One count per bucket plus the +Inf bucket; cumulated when exported.
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestTimings:
+    def __init__(self):
+        self.sql_count: int = 0
+        self.sql_seconds: float = 0.0
+        self.finance_seconds: float = 0.0
+
+
+current_timings: ContextVar[Optional[RequestTimings]] = ContextVar("current_timings", default=None)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.request_seconds: Dict[Tuple[str, str, int], Histogram] = defaultdict(Histogram)
+        self.sql_statement_seconds: Histogram = Histogram()
+        self.sql_statements: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.sql_seconds: Dict[Tuple[str, str], float] = defaultdict(float)
+        self.finance_seconds: Dict[Tuple[str, str], float] = defaultdict(float)
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float, request_timings: RequestTimings):
+        with self._lock:
+            self.request_seconds[(method, route, status)].observe(seconds)
+            self.sql_statements[(method, route)] += request_timings.sql_count
+            self.sql_seconds[(method, route)] += request_timings.sql_seconds
+            self.finance_seconds[(method, route)] += request_timings.finance_seconds
+
+    def observe_sql_statement(self, seconds: float):
+        with self._lock:
+            self.sql_statement_seconds.observe(seconds)
+
+    def clear(self):
+        with self._lock:
+            self.reset()
+
+    def render(self):
+        lines: List[str] = []
+        with self._lock:
+            lines += [
+                "# HELP loan_app_request_duration_seconds Time from request start to the last response byte.",
+                "# TYPE loan_app_request_duration_seconds histogram"
+            ]
+            for (method, route, status), histogram in sorted(self.request_seconds.items()):
+                labels: str = f'method="{method}",route="{route}",status="{status}"'
+                lines += format_histogram("loan_app_request_duration_seconds", labels, histogram)
+            lines += [
+                "# HELP loan_app_sql_statement_duration_seconds Time spent in each SQL statement execution.",
+                "# TYPE loan_app_sql_statement_duration_seconds histogram"
+            ]
+            lines += format_histogram("loan_app_sql_statement_duration_seconds", "", self.sql_statement_seconds)
+            for name, help_text, values in [
+                ("loan_app_sql_statements_total", "SQL statements executed while serving a route.", self.sql_statements),
+                ("loan_app_sql_seconds_total", "Time spent in SQL statements while serving a route.", self.sql_seconds),
+                ("loan_app_finance_seconds_total", "Time spent in finance math while serving a route.", self.finance_seconds)
+            ]:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for (method, route), value in sorted(values.items()):
+                    lines.append(f'{name}{{method="{method}",route="{route}"}} {value}')
+        for key, value in finance.schedule_cache.stats().items():
+            kind: str = "counter" if key in ("hits", "misses", "evictions") else "gauge"
+            name = f"loan_app_schedule_cache_{key}" + ("_total" if kind == "counter" else "")
+            lines += [f"# TYPE {name} {kind}", f"{name} {value}"]
+        lookup_cache_stats: Dict[str, Dict[str, float]] = lookup_cache.stats()
+        for key, kind in [("hits", "counter"), ("misses", "counter"), ("hit_ratio", "gauge")]:
+            name = f"loan_app_lookup_cache_{key}" + ("_total" if kind == "counter" else "")
+            lines.append(f"# TYPE {name} {kind}")
+            for namespace, stats in lookup_cache_stats.items():
+                lines.append(f'{name}{{namespace="{namespace}"}} {stats[key]}')
+        return "\n".join(lines) + "\n"
+
+
+def format_histogram(name: str, labels: str, histogram: Histogram):
+    separator: str = "," if labels else ""
+    lines: List[str] = []
+    cumulative_count: int = 0
+    for bucket, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+        cumulative_count += count
+        le: str = "+Inf" if bucket == float("inf") else repr(bucket)
+        lines.append(f'{name}_bucket{{{labels}{separator}le="{le}"}} {cumulative_count}')
+    suffix: str = f"{{{labels}}}" if labels else ""
+    lines.append(f"{name}_sum{suffix} {histogram.sum}")
+    lines.append(f"{name}_count{suffix} {histogram.count}")
+    return lines
+
+
+registry = MetricsRegistry()
+
+
+@contextmanager
+def time_finance():
+    # Charges the enclosed block to the current request's finance time.
+    request_timings: Optional[RequestTimings] = current_timings.get()
+    start: float = time.perf_counter()
+    try:
+        yield
+    finally:
+        if request_timings is not None:
+            request_timings.finance_seconds += time.perf_counter() - start
+
+
+def timed_finance(function: Callable):
+    @wraps(function)
+    def timed_function(*args, **kwargs):
+        with time_finance():
+            return function(*args, **kwargs)
+
+    return timed_function
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if METRICS_ENABLED:
+        connection.info.setdefault("metrics_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    starts: Optional[List[float]] = connection.info.get("metrics_start")
+    if not starts:
+        return
+    seconds: float = time.perf_counter() - starts.pop()
+    registry.observe_sql_statement(seconds)
+    request_timings: Optional[RequestTimings] = current_timings.get()
+    if request_timings is not None:
+        request_timings.sql_count += 1
+        request_timings.sql_seconds += seconds
+
+
+def get_route_label(scope: Dict):
+    # Route templates, not raw paths, keep the label set bounded.
+    route = scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+
+def get_server_timing(request_timings: RequestTimings, total_seconds: float):
+    app_seconds: float = max(total_seconds - request_timings.sql_seconds - request_timings.finance_seconds, 0.0)
+    return (
+        f'db;dur={request_timings.sql_seconds * 1000:.3f};desc="{request_timings.sql_count} queries", '
+        f"finance;dur={request_timings.finance_seconds * 1000:.3f}, "
+        f"app;dur={app_seconds * 1000:.3f}, "
+        f"total;dur={total_seconds * 1000:.3f}"
+    )
+
+
+class MetricsMiddleware:
+    # Plain ASGI rather than BaseHTTPMiddleware so streaming responses pass
+    # through untouched. Does nothing unless LOAN_APP_METRICS=1.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        request_timings = RequestTimings()
+        token = current_timings.set(request_timings)
+        start: float = time.perf_counter()
+        status: int = 500
+
+        async def send_with_server_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                # The header goes out with the response head, so for streamed
+                # bodies it covers the time to first byte.
+                status = message["status"]
+                server_timing: str = get_server_timing(request_timings, time.perf_counter() - start)
+                message["headers"] = list(message.get("headers", [])) + [(SERVER_TIMING_HEADER, server_timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_server_timing)
+        finally:
+            current_timings.reset(token)
+            registry.observe_request(
+                scope["method"], get_route_label(scope), status, time.perf_counter() - start, request_timings
+            )
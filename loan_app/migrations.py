@@ -0,0 +1,142 @@
+import argparse
+import os
+from datetime import datetime, timezone
+from typing import Callable, List, NamedTuple, Set
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, insert, select, text
+from sqlalchemy.engine import Connection, Engine
+from . import database, models
+
+
+# With several workers per host, set this to 0 and run
+# `python -m loan_app.migrations upgrade` once per deploy instead.
+MIGRATE_ON_STARTUP: bool = os.environ.get("LOAN_APP_MIGRATE_ON_STARTUP", "1") == "1"
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[Connection], None]
+
+
+migrations_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    migrations_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False)
+)
+
+
+def create_schema(connection: Connection):
+    # Tables that already exist, e.g. in a database created before
+    # migrations were versioned, are left alone for later steps to alter.
+    models.Base.metadata.create_all(bind=connection)
+
+
+def migrate_user_loan(connection: Connection):
+    # Databases created before user_loan got its composite primary key still
+    # have the surrogate id column. The table is rebuilt, dropping duplicate
+    # and half-empty rows the new key would reject. The old table is dropped
+    # rather than renamed so its constraint and index names (user_loan_pkey
+    # on PostgreSQL) are free for the new one.
+    if not inspect(connection).has_table("user_loan"):
+        return False
+    columns = {column["name"] for column in inspect(connection).get_columns("user_loan")}
+    if "id" not in columns:
+        return False
+    connection.execute(text(
+        "CREATE TABLE user_loan_rows AS SELECT DISTINCT user_id, loan_id FROM user_loan "
+        "WHERE user_id IS NOT NULL AND loan_id IS NOT NULL"
+    ))
+    connection.execute(text("DROP TABLE user_loan"))
+    models.UserLoan.__table__.create(connection)
+    connection.execute(text("INSERT INTO user_loan (user_id, loan_id) SELECT user_id, loan_id FROM user_loan_rows"))
+    connection.execute(text("DROP TABLE user_loan_rows"))
+    return True
+
+
+def analyze(connection: Connection):
+    # Planner statistics decide between an index range plus a sort and an
+    # id-ordered scan for loan searches; rerun after large bulk loads.
+    if connection.dialect.name in ("sqlite", "postgresql"):
+        connection.execute(text("ANALYZE"))
+
+
+def create_search_indexes(connection: Connection):
+    # Databases created at version 1 by an older models module lack these;
+    # fresh ones already got them from create_schema.
+    for table in (models.Loan.__table__, models.LoanScheduleMonth.__table__):
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+    analyze(connection)
+
+
+# Append only: a released version never changes, new schema work gets the
+# next number. Steps only replay on databases that already have tables; an
+# empty one gets the current models at once, with every version stamped, so
+# a step may assume the schema of the version before it.
+MIGRATIONS: List[Migration] = [
+    Migration(1, "create_schema", create_schema),
+    Migration(2, "user_loan_composite_key", migrate_user_loan),
+    Migration(3, "loan_search_indexes", create_search_indexes)
+]
+HEAD: int = MIGRATIONS[-1].version
+
+
+def get_applied_versions(connection: Connection):
+    if not inspect(connection).has_table(schema_migrations.name):
+        return set()
+    return set(connection.scalars(select(schema_migrations.c.version)))
+
+
+def upgrade(connection: Connection):
+    applied_versions: Set[int] = get_applied_versions(connection)
+    pending: List[Migration] = [migration for migration in MIGRATIONS if migration.version not in applied_versions]
+    if not pending:
+        return []
+    is_empty: bool = not applied_versions and not any(
+        inspect(connection).has_table(table_name) for table_name in models.Base.metadata.tables
+    )
+    migrations_metadata.create_all(bind=connection)
+    if is_empty:
+        models.Base.metadata.create_all(bind=connection)
+    for migration in pending:
+        if not is_empty:
+            migration.apply(connection)
+        connection.execute(insert(schema_migrations).values(
+            version=migration.version, name=migration.name, applied_at=datetime.now(timezone.utc)
+        ))
+    return [migration.version for migration in pending]
+
+
+def upgrade_engine(bind: Engine):
+    with bind.begin() as connection:
+        return upgrade(connection)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply or inspect versioned schema migrations.")
+    parser.add_argument("command", nargs="?", choices=["upgrade", "current", "history", "analyze"], default="upgrade")
+    args = parser.parse_args()
+    engine: Engine = database.engine
+    if args.command == "upgrade":
+        applied: List[int] = upgrade_engine(engine)
+        print(f"Applied migrations {applied}" if applied else f"Database schema is up to date (version {HEAD})")
+        return
+    if args.command == "analyze":
+        with engine.begin() as connection:
+            analyze(connection)
+        return
+    with engine.connect() as connection:
+        applied_versions: Set[int] = get_applied_versions(connection)
+    if args.command == "current":
+        print(max(applied_versions, default=0))
+        return
+    for migration in MIGRATIONS:
+        status: str = "applied" if migration.version in applied_versions else "pending"
+        print(f"{migration.version:>4} {migration.name:<32} {status}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,19 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Table
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, String, Table
 from sqlalchemy.orm import relationship
 from .database import Base
 
 
 class UserLoan(Base):
+    # The primary key answers "loans of a user" and the reverse index "users
+    # of a loan", both as index range scans. On SQLite the table is stored
+    # WITHOUT ROWID, i.e. clustered on (user_id, loan_id).
     __tablename__ = "user_loan"
-    id = Column(Integer, primary_key=True)
-    user_id = Column('user_id', Integer, ForeignKey('users.id'))
-    loan_id = Column('loan_id', Integer, ForeignKey('loans.id'))
+    user_id = Column('user_id', Integer, ForeignKey('users.id'), primary_key=True)
+    loan_id = Column('loan_id', Integer, ForeignKey('loans.id'), primary_key=True)
+    __table_args__ = (
+        Index("ix_user_loan_loan_id_user_id", "loan_id", "user_id"),
+        {"sqlite_with_rowid": False}
+    )
 
 
 class User(Base):
@@ -24,3 +30,27 @@ class Loan(Base):
     rate = Column(Integer)
     term = Column(Integer)
     users = relationship("User", secondary='user_loan', back_populates="loans")
+    # Range searches (crud.search_loans): term-led, rate-led and amount-led.
+    # Every index also carries the rowid, so matches come back id-ordered
+    # within each equal prefix.
+    __table_args__ = (
+        Index("ix_loans_term_rate_amount", "term", "rate", "amount"),
+        Index("ix_loans_rate_amount", "rate", "amount"),
+        Index("ix_loans_amount", "amount")
+    )
+
+
+class LoanScheduleMonth(Base):
+    __tablename__ = "loan_schedule"
+    loan_id = Column(Integer, ForeignKey('loans.id'), primary_key=True)
+    month = Column(Integer, primary_key=True)
+    interest_payment = Column(Integer)
+    principal_payment = Column(Integer)
+    monthly_payment = Column(Integer)
+    remaining_balance = Column(Integer)
+    aggregate_principal_paid = Column(Integer)
+    aggregate_interest_paid = Column(Integer)
+    # Balance range searches at a given month on persisted schedules.
+    __table_args__ = (
+        Index("ix_loan_schedule_month_remaining_balance", "month", "remaining_balance"),
+    )
@@ -0,0 +1,32 @@
+import base64
+import json
+from typing import List, Optional
+from fastapi import HTTPException, Response
+
+
+NEXT_CURSOR_HEADER: str = "X-Next-Cursor"
+
+
+def encode_cursor(after_id: int):
+    payload: bytes = json.dumps({"after_id": after_id}).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]):
+    if not cursor:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        after_id = payload["after_id"]
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(after_id, int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return after_id
+
+
+def set_next_cursor(response: Response, page: List, limit: int):
+    # A short page is the last one; otherwise hand back the last id seen so
+    # the client can continue in keyset mode.
+    if limit > 0 and len(page) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(page[-1].id)
@@ -0,0 +1,104 @@
+import os
+from itertools import product
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from fastapi import HTTPException
+from . import finance
+
+
+# Standard grid whose annuity factors are computed at startup, as values or
+# inclusive start:stop:step ranges (rates in 0.01%, terms in months).
+QUOTE_RATES: str = os.environ.get("LOAN_APP_QUOTE_RATES", "0:3000:25")
+QUOTE_TERMS: str = os.environ.get("LOAN_APP_QUOTE_TERMS", "12:84:12,120,180,240,300,360")
+MAX_QUOTES: int = int(os.environ.get("LOAN_APP_MAX_QUOTES", "10000"))
+# Exact annuity factors slow down sharply with the term, and summaries
+# allocate quotes x term arrays, so longer terms are refused.
+MAX_QUOTE_TERM: int = int(os.environ.get("LOAN_APP_MAX_QUOTE_TERM", "600"))
+QUOTE_FIELDS: Tuple[str, ...] = ("amount", "rate", "term", "monthly_payment", "total_payment", "total_interest", "summary")
+SUMMARY_FIELDS: Tuple[str, ...] = ("month", "principal_balance", "aggregate_principal_paid", "aggregate_interest_paid")
+
+# (rate, term) -> finance.get_annuity_factor(rate, term). Unlike the
+# finance LRU, entries here are never evicted by portfolio traffic.
+annuity_factors: Dict[Tuple[int, int], Tuple[int, int, int]] = {}
+
+
+def parse_ranges(values: Iterable[str]):
+    # Single values become one-element ranges, so a query is sized with
+    # len(range) before anything is expanded.
+    ranges: List[range] = []
+    for value in values:
+        for part in value.split(","):
+            if ":" not in part:
+                ranges.append(range(int(part), int(part) + 1))
+                continue
+            start, stop, step = (int(bound) for bound in part.split(":"))
+            if step <= 0:
+                raise ValueError(f"Invalid range {part}")
+            ranges.append(range(start, stop + 1, step))
+    return ranges
+
+
+def parse_values(values: Iterable[str]):
+    return [value for values_range in parse_ranges(values) for value in values_range]
+
+
+def get_value_count(ranges: Sequence[range]):
+    return sum(len(values_range) for values_range in ranges)
+
+
+def get_query_ranges(name: str, values: Iterable[str], minimum: int, maximum: Optional[int] = None):
+    try:
+        ranges: List[range] = [values_range for values_range in parse_ranges(values) if values_range]
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}")
+    if not ranges or min(values_range[0] for values_range in ranges) < minimum:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}")
+    if maximum is not None and max(values_range[-1] for values_range in ranges) > maximum:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}")
+    if get_value_count(ranges) > MAX_QUOTES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_QUOTES} quotes per request")
+    return ranges
+
+
+def precompute_annuity_factors(rates: Optional[Sequence[int]] = None, terms: Optional[Sequence[int]] = None):
+    rates = parse_values([QUOTE_RATES]) if rates is None else rates
+    terms = parse_values([QUOTE_TERMS]) if terms is None else terms
+    for rate, term in product(rates, terms):
+        annuity_factors[(rate, term)] = finance.get_annuity_factor(rate, term)
+    return len(annuity_factors)
+
+
+def get_annuity_factor(rate: int, term: int):
+    annuity_factor: Optional[Tuple[int, int, int]] = annuity_factors.get((rate, term))
+    if annuity_factor is None:
+        annuity_factor = finance.get_annuity_factor(rate, term)
+    return annuity_factor
+
+
+def get_quote_rows(amounts: Sequence[int], rates: Sequence[int], terms: Sequence[int], month: Optional[int] = None):
+    # One row per amount x rate x term. Totals are the level-payment figures,
+    # monthly_payment * term; the schedule's final payment differs by the
+    # few cents of interest rounding it absorbs. Summaries, which need the
+    # schedule, come from one vectorized pass over all quotes that reach
+    # `month`.
+    rows: List[List] = []
+    for amount, rate, term in product(amounts, rates, terms):
+        monthly_payment: int = finance.get_pmt_from_factor(amount, get_annuity_factor(rate, term))
+        total_payment: int = monthly_payment * term
+        rows.append([amount, rate, term, monthly_payment, total_payment, total_payment - amount, None])
+    if month is None:
+        return rows
+    indexes: List[int] = [index for index, row in enumerate(rows) if month < row[2]]
+    if not indexes:
+        return rows
+    portfolio_schedules = finance.get_portfolio_schedules([
+        finance.LoanTerms(index, rows[index][0], rows[index][1], rows[index][2]) for index in indexes
+    ])
+    principal_balances: np.ndarray = portfolio_schedules.remaining_balance[:, month]
+    principal_paid: np.ndarray = portfolio_schedules.principal_payment[:, 1:month + 1].sum(axis=1)
+    interest_paid: np.ndarray = portfolio_schedules.interest_payment[:, 1:month + 1].sum(axis=1)
+    for index, principal_balance, aggregate_principal_paid, aggregate_interest_paid in zip(
+        indexes, principal_balances.tolist(), principal_paid.tolist(), interest_paid.tolist()
+    ):
+        rows[index][6] = dict(zip(SUMMARY_FIELDS, (month, principal_balance, aggregate_principal_paid, aggregate_interest_paid)))
+    return rows
@@ -0,0 +1,36 @@
+import argparse
+from sqlalchemy.orm import Session
+from . import crud, database
+
+
+def rebuild_schedules(db: Session, chunk_size: int = 1000):
+    # Recomputes loan_schedule from the loans table, e.g. after the finance
+    # rules change. Each chunk of loans is written in its own transaction.
+    crud.delete_loan_schedules(db)
+    db.commit()
+    loan_count: int = 0
+    after_id = None
+    while True:
+        db_loans = crud.get_loan_terms(db, limit=chunk_size, after_id=after_id)
+        if not db_loans:
+            return loan_count
+        crud.create_loan_schedules(db, db_loans)
+        db.commit()
+        loan_count += len(db_loans)
+        after_id = db_loans[-1].id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the materialized loan_schedule table.")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+    db = database.SessionLocal()
+    try:
+        loan_count: int = rebuild_schedules(db, chunk_size=args.chunk_size)
+    finally:
+        db.close()
+    print(f"Rebuilt schedules for {loan_count} loans")
+
+
+if __name__ == "__main__":
+    main()
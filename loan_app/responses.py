@@ -0,0 +1,100 @@
+import hashlib
+import os
+from typing import Dict, List, Literal, Sequence, Tuple
+import orjson
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+from . import finance, models, streaming
+
+
+# Schedules and summaries only change with the loan terms and
+# finance.FINANCE_VERSION, both part of their ETag, so clients and proxies
+# may keep them this long and then revalidate.
+SCHEDULE_MAX_AGE: int = int(os.environ.get("LOAN_APP_SCHEDULE_MAX_AGE", "86400"))
+# Starlette ships gzip only; responses smaller than the minimum size go out
+# uncompressed.
+GZIP_ENABLED: bool = os.environ.get("LOAN_APP_GZIP", "0") == "1"
+GZIP_MINIMUM_SIZE: int = int(os.environ.get("LOAN_APP_GZIP_MINIMUM_SIZE", "4096"))
+# "records" is the regular list of objects; "columns" maps each field to a
+# list of values and "tuples" sends the field names once next to plain rows.
+Layout = Literal["records", "columns", "tuples"]
+USER_FIELDS: Tuple[str, ...] = ("email", "id")
+LOAN_FIELDS: Tuple[str, ...] = ("amount", "rate", "term", "id", "users")
+
+
+class ORJSONResponse(JSONResponse):
+    # Content is already shaped like the response_model, so it goes straight
+    # to orjson instead of through FastAPI's validate-then-encode pass.
+    def render(self, content):
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def get_layout_content(fields: Tuple[str, ...], rows: Sequence[Tuple], layout: Layout):
+    if layout == "columns":
+        columns = zip(*rows) if rows else [()] * len(fields)
+        return {field: list(column) for field, column in zip(fields, columns)}
+    if layout == "tuples":
+        return {"fields": fields, "rows": rows}
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def get_user_row(db_user: models.User):
+    return (db_user.email, db_user.id)
+
+
+def get_loan_row(db_loan: models.Loan):
+    users: List[Dict] = [{"email": db_user.email, "id": db_user.id} for db_user in db_loan.users]
+    return (db_loan.amount, db_loan.rate, db_loan.term, db_loan.id, users)
+
+
+def get_users_content(db_users: List[models.User], layout: Layout = "records"):
+    return get_layout_content(USER_FIELDS, [get_user_row(db_user) for db_user in db_users], layout)
+
+
+def get_loans_content(db_loans: List[models.Loan], layout: Layout = "records"):
+    return get_layout_content(LOAN_FIELDS, [get_loan_row(db_loan) for db_loan in db_loans], layout)
+
+
+def get_loan_schedule_content(columns: finance.LoanSchedule, layout: Layout = "records"):
+    # The numpy columns serialize as-is; only "records" has to build dicts.
+    if layout == "columns":
+        return columns.to_dict()
+    if layout == "tuples":
+        return {"fields": streaming.SCHEDULE_FIELDS, "rows": columns.to_numpy()}
+    return columns.to_rows()
+
+
+def get_etag(*parts):
+    # Validator for a representation that is a pure function of `parts`
+    # under the current finance rules. With gzip on, the same tag goes out
+    # with compressed and identity bodies, so it is only a weak one.
+    key: str = ":".join(str(part) for part in (finance.FINANCE_VERSION, *parts))
+    etag: str = '"' + hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + '"'
+    return "W/" + etag if GZIP_ENABLED else etag
+
+
+def get_cache_headers(etag: str, vary: Sequence[str] = ()):
+    # `vary` names the request headers that pick the representation at this
+    # URL.
+    headers: Dict[str, str] = {"ETag": etag, "Cache-Control": f"public, max-age={SCHEDULE_MAX_AGE}"}
+    if vary:
+        headers["Vary"] = ", ".join(vary)
+    return headers
+
+
+def is_not_modified(request: Request, etag: str):
+    # If-None-Match uses the weak comparison, so W/ tags added by proxies
+    # still match.
+    if_none_match: str = request.headers.get("if-none-match", "")
+    if not if_none_match:
+        return False
+    tags: List[str] = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+def get_not_modified_response(etag: str, vary: Sequence[str] = ()):
+    # The gzip middleware adds Accept-Encoding to the Vary of every body big
+    # enough to compress, but never sees one in a 304.
+    if GZIP_ENABLED:
+        vary = (*vary, "Accept-Encoding")
+    return Response(status_code=304, headers=get_cache_headers(etag, vary))
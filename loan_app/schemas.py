@@ -1,4 +1,4 @@
-from typing import List, Union
+from typing import List, Literal, Optional, Union
 from pydantic import BaseModel
 
 
@@ -36,6 +36,38 @@ class Loan(LoanBase):
         from_attributes = True
 
 
+class LoanSearch(BaseModel):
+    # Inclusive bounds. The balance bounds apply to the principal balance at
+    # `month` as /loans/{loan_id}/summary reports it, so they only match
+    # loans whose term runs past `month`.
+    amount_min: Optional[int] = None
+    amount_max: Optional[int] = None
+    rate_min: Optional[int] = None
+    rate_max: Optional[int] = None
+    term_min: Optional[int] = None
+    term_max: Optional[int] = None
+    user_id: Optional[int] = None
+    balance_min: Optional[int] = None
+    balance_max: Optional[int] = None
+    month: int = 0
+
+
+class BulkItemResult(BaseModel):
+    index: int
+    id: Optional[int] = None
+    detail: Optional[str] = None
+
+
+class BulkResult(BaseModel):
+    created: int
+    failed: int
+    items: List[BulkItemResult]
+
+
+class LoanScheduleBatchCreate(BaseModel):
+    loan_ids: List[int] = []
+
+
 class LoanScheduleMonth(BaseModel):
     month: int
     interest_payment: int
@@ -50,3 +82,62 @@ class LoanSummary(BaseModel):
     principal_balance: int
     aggregate_principal_paid: int
     aggregate_interest_paid: int
+
+
+class CashflowMonth(BaseModel):
+    month: int
+    interest_payment: int
+    principal_payment: int
+    total_payment: int
+    remaining_balance: int
+
+
+class QuoteSummary(BaseModel):
+    month: int
+    principal_balance: int
+    aggregate_principal_paid: int
+    aggregate_interest_paid: int
+
+
+class Quote(LoanBase):
+    monthly_payment: int
+    total_payment: int
+    total_interest: int
+    summary: Optional[QuoteSummary] = None
+
+
+class LoanScenario(BaseModel):
+    # Months are 1-based schedule months; unset months mean "never".
+    name: Optional[str] = None
+    extra_principal: int = 0
+    extra_principal_start_month: int = 1
+    lump_sum: int = 0
+    lump_sum_month: int = 1
+    rate_reset_month: Optional[int] = None
+    reset_rate: Optional[int] = None
+    payoff_month: Optional[int] = None
+
+
+ScenarioOutput = Literal["total_interest", "total_principal", "payoff_month", "interest_delta", "payoff_month_delta", "balances"]
+
+
+class ScenarioRequest(BaseModel):
+    scenarios: List[LoanScenario] = []
+    # Remaining balance is reported after each of these months.
+    balance_months: List[int] = []
+    outputs: List[ScenarioOutput] = ["total_interest", "interest_delta", "payoff_month", "payoff_month_delta"]
+
+
+class ScenarioResult(BaseModel):
+    name: Optional[str] = None
+    total_interest: Optional[int] = None
+    total_principal: Optional[int] = None
+    payoff_month: Optional[int] = None
+    interest_delta: Optional[int] = None
+    payoff_month_delta: Optional[int] = None
+    balances: Optional[List[int]] = None
+
+
+class ScenarioResults(BaseModel):
+    base: ScenarioResult
+    scenarios: List[ScenarioResult]
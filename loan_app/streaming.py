@@ -0,0 +1,57 @@
+from itertools import islice
+from typing import Iterable, Iterator, Tuple
+from . import finance
+
+
+NDJSON_MEDIA_TYPE: str = "application/x-ndjson"
+CSV_MEDIA_TYPE: str = "text/csv"
+SCHEDULE_FIELDS: Tuple[str, ...] = (
+    "month", "interest_payment", "principal_payment", "monthly_payment", "remaining_balance"
+)
+ROWS_PER_CHUNK: int = 120
+
+
+def get_stream_media_type(accept: str):
+    # Only an explicit opt-in streams; browsers and the default client send
+    # */* or application/json and keep getting the JSON array.
+    media_types = {media_type.split(";")[0].strip() for media_type in accept.split(",")}
+    for media_type in (NDJSON_MEDIA_TYPE, CSV_MEDIA_TYPE):
+        if media_type in media_types:
+            return media_type
+    return None
+
+
+def get_row_template(media_type: str, with_loan_id: bool):
+    fields: Tuple[str, ...] = (("loan_id",) if with_loan_id else ()) + SCHEDULE_FIELDS
+    if media_type == CSV_MEDIA_TYPE:
+        return ",".join(["%d"] * len(fields)) + "\n"
+    return "{" + ",".join(f'"{field}":%d' for field in fields) + "}\n"
+
+
+def get_header(media_type: str, with_loan_id: bool):
+    if media_type != CSV_MEDIA_TYPE:
+        return ""
+    return ",".join((("loan_id",) if with_loan_id else ()) + SCHEDULE_FIELDS) + "\n"
+
+
+def iter_schedule_lines(media_type: str, rows: Iterable[Tuple[int, ...]], with_loan_id: bool = False, header: bool = True):
+    row_template: str = get_row_template(media_type, with_loan_id)
+    if header and media_type == CSV_MEDIA_TYPE:
+        yield get_header(media_type, with_loan_id)
+    rows = iter(rows)
+    while True:
+        chunk = "".join(row_template % row for row in islice(rows, ROWS_PER_CHUNK))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_portfolio_schedule_rows(portfolio_schedules: finance.PortfolioScheduleColumns):
+    for index, loan_id in enumerate(portfolio_schedules.loan_id.tolist()):
+        for row in portfolio_schedules.get_loan_schedule_columns(index):
+            yield (loan_id,) + row
+
+
+def format_portfolio_schedules(media_type: str, portfolio_schedules: finance.PortfolioScheduleColumns):
+    rows: Iterator[Tuple[int, ...]] = iter_portfolio_schedule_rows(portfolio_schedules)
+    return "".join(iter_schedule_lines(media_type, rows, with_loan_id=True, header=False))
@@ -0,0 +1,71 @@
+import os
+from typing import Dict, List
+from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
+from . import crud, database, finance, quotes
+
+
+# "1" warms a worker up before it accepts requests, "background" lets it
+# accept requests at once and warms up alongside, "0" skips it and leaves
+# everything to be computed on demand.
+WARMUP: str = os.environ.get("LOAN_APP_WARMUP", "1")
+# Schedules of this many of the most common (amount, rate, term) products
+# are put into finance.schedule_cache. Finding them groups the whole loans
+# table, hence off by default.
+WARMUP_SCHEDULES: int = int(os.environ.get("LOAN_APP_WARMUP_SCHEDULES", "0"))
+
+
+def connect(engine):
+    with engine.connect():
+        pass
+
+
+def cache_schedules(products: List[finance.LoanProduct]):
+    for product in products:
+        finance.schedule_cache.get(product.amount, product.rate, product.term)
+    return len(products)
+
+
+async def get_common_products(limit: int):
+    if database.AsyncSessionLocal is not None:
+        async with database.AsyncSessionLocal() as db:
+            return await crud.run(db, crud.get_loan_products, limit=limit)
+    with database.SessionLocal() as db:
+        return await crud.run(db, crud.get_loan_products, limit=limit)
+
+
+async def send_request(app: FastAPI, path: str):
+    # One GET through the whole middleware stack without a server. FastAPI
+    # prepares its routes lazily on the first request that reaches the
+    # router, tens of milliseconds otherwise paid by a real client.
+    statuses: List[int] = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+
+    await app({
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "", "headers": [],
+        "client": None, "server": None
+    }, receive, send)
+    return statuses[0]
+
+
+async def warm_up(app: FastAPI):
+    await send_request(app, "/")
+    warmed: Dict[str, int] = {"annuity_factors": await run_in_threadpool(quotes.precompute_annuity_factors)}
+    # The first pooled connection (with its SQLite pragmas) is opened here
+    # rather than by the first request.
+    if database.async_engine is not None:
+        async with database.async_engine.connect():
+            pass
+    else:
+        await run_in_threadpool(connect, database.engine)
+    if WARMUP_SCHEDULES > 0:
+        products: List[finance.LoanProduct] = await get_common_products(WARMUP_SCHEDULES)
+        warmed["schedules"] = await run_in_threadpool(cache_schedules, products)
+    return warmed